@@ -0,0 +1,194 @@
+"""
+`benchds248x`
+================================================================================
+
+Benchmarks for the ds248x driver, run on the target with a DS248x adapter
+and DS18B20 sensors attached, or on the unix port and CPython against the
+DS248x and DS18B20 devices emulated by the machine shim.
+
+"""
+
+import gc
+import time
+from ds248x import DS248x
+try:
+    from time import ticks_ms, ticks_diff
+except ImportError: # CPython, time ticks from the emulation
+    from sched import ticks_ms, ticks_diff
+
+
+def heap_used() -> int:
+    """
+    Heap currently allocated, gc.mem_alloc on micropython, traced memory
+    on CPython where it only shows what is retained.
+
+    :return: The allocated heap in bytes
+    """
+    try:
+        return gc.mem_alloc()
+    except AttributeError:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0]
+
+
+def bench_heap(ds: DS248x, rom: bytearray, n: int = 100) -> tuple:
+    """
+    Measure the heap allocated per temperature read with garbage
+    collection disabled, for the raw integer and the float reads. Only
+    gc.mem_alloc on micropython is exact: on CPython the counters above
+    256 and the emulated devices allocate as well.
+
+    :param ds: The driver instance
+    :param rom: The ROM address of a DS18B20 sensor
+    :param n: The number of reads
+    :return: The bytes allocated per raw read and per float read
+    """
+    ds.ds18b20_read_raw(rom) # warm up lazily created counters
+    ds.ds18b20_read_temperature(rom)
+    res = []
+    for read in (ds.ds18b20_read_raw, ds.ds18b20_read_temperature):
+        gc.collect()
+        gc.disable()
+        start = heap_used()
+        for _ in range(n):
+            read(rom)
+        growth = heap_used() - start
+        gc.enable()
+        res.append(growth / n)
+    return tuple(res)
+
+
+def search(ds: DS248x, bitwise: bool = False) -> list:
+    """
+    Find all the devices on the bus.
+
+    :param ds: The driver instance
+    :param bitwise: Use the single bit search instead of the triplets
+    :return: The list of ROM addresses
+    """
+    step = ds.onewire_search_bitwise if bitwise else ds.onewire_search
+    ds.onewire_search_reset()
+    roms = []
+    while True:
+        rom = bytearray(8)
+        if not step(rom):
+            break
+        roms.append(rom)
+    return roms
+
+
+def bench_search(ds: DS248x, nchannels: int = 1, bitwise: bool = False) -> tuple:
+    """
+    Measure a full search of all the channels.
+
+    :param ds: The driver instance
+    :param nchannels: The number of channels to search
+    :param bitwise: Use the single bit search instead of the triplets
+    :return: The ROM addresses per channel, the milliseconds and
+             the I2C transactions taken
+    """
+    roms = []
+    start = ticks_ms()
+    count = ds.i2c_transactions
+    for chan in range(nchannels):
+        if nchannels > 1:
+            ds.channel = chan
+        roms.append(search(ds, bitwise))
+    return (roms, ticks_diff(ticks_ms(), start),
+            ds.i2c_transactions - count)
+
+
+def bench_round(ds: DS248x, roms: list, verify: bool = True) -> tuple:
+    """
+    Measure a read round as done by the bus tool: one conversion per
+    channel, then each sensor read on its channel. The conversion wait
+    is left out.
+
+    :param ds: The driver instance
+    :param roms: The ROM addresses per channel
+    :param verify: Read the whole scratchpad and check the CRC
+    :return: The milliseconds and the I2C transactions per sensor read,
+             and the failed reads
+    """
+    nchannels = len(roms)
+    for chan in range(nchannels):
+        if nchannels > 1:
+            ds.channel = chan
+        ds.ds18b20_convert_all()
+    time.sleep(0.75)
+    ds.verify_crc = verify
+    failed = 0
+    nread = 0
+    start = ticks_ms()
+    count = ds.i2c_transactions
+    for chan in range(nchannels):
+        if nchannels > 1:
+            ds.channel = chan
+        for rom in roms[chan]:
+            nread += 1
+            try:
+                ds.ds18b20_read_raw(rom)
+            except RuntimeError:
+                failed += 1
+    ds.verify_crc = True
+    nread = max(nread, 1)
+    return (ticks_diff(ticks_ms(), start) / nread,
+            (ds.i2c_transactions - count) / nread, failed)
+
+
+def simulated(nsensors: int = 10, nchannels: int = 1) -> DS248x:
+    """
+    Build a driver on the emulated I2C bus of the machine shim, with the
+    sensors spread over the channels of a DS2484 or DS2482-800.
+
+    :param nsensors: The number of DS18B20 sensors
+    :param nchannels: The number of channels of the adapter
+    :return: The driver instance
+    """
+    from machine import I2C, DS248xDevice, OneWireDS18B20
+    i2c = I2C(1)
+    dev = i2c.attach(0x18, DS248xDevice(i2c, nchannels))
+    for i in range(nsensors):
+        dev.add(OneWireDS18B20(0x1000 + 37*i, 15.0 + i/4), i % nchannels)
+    return DS248x(i2c)
+
+
+def run(ds: DS248x, nchannels: int = 1) -> None:
+    """
+    Run the benchmarks and print the results.
+
+    :param ds: The driver instance
+    :param nchannels: The number of channels to use
+    """
+    for bitwise in (False, True):
+        roms, ms, count = bench_search(ds, nchannels, bitwise)
+        print("%s search: %d devices, %d ms, %d i2c transactions" % (
+            "bitwise" if bitwise else "triplet",
+            sum(len(r) for r in roms), ms, count))
+    if not sum(len(r) for r in roms):
+        return
+    for verify in (True, False):
+        ms, count, failed = bench_round(ds, roms, verify)
+        print("%s read: %.2f ms, %.1f i2c transactions per sensor, %d failed" % (
+            "verified" if verify else "fast", ms, count, failed))
+    if nchannels > 1:
+        ds.channel = 0
+    raw, flt = bench_heap(ds, roms[0][0])
+    print("heap per read: raw %.1f bytes, float %.1f bytes" % (raw, flt))
+    if hasattr(gc, "mem_alloc"): # the raw read must not allocate at all
+        print("zero allocation raw read: %s" % ("PASS" if raw == 0 else "FAIL"))
+    else: # traced memory is not exact enough to tell
+        print("zero allocation raw read: SKIP (needs gc.mem_alloc)")
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.platform in ("linux", "darwin", "win32"):
+        for nchannels in (1, 8):
+            print("emulated DS248x, %d channel(s), 10 sensors" % nchannels)
+            run(simulated(10, nchannels), nchannels)
+    else:
+        from machine import I2C, Pin
+        run(DS248x(I2C(1, scl=Pin(22), sda=Pin(21))))
@@ -0,0 +1,476 @@
+
+# runnable checks of knova tools, on the unix port or CPython with the
+# machine and sched shims: python3 checkknova.py, an AssertionError
+# tells the first failure
+
+import array
+import machine
+import knova
+from knova import KnovaTool, KnovaMultiTool, KnovaDispatcher, KnovaSimulator
+
+
+# downstream tool recording what reaches it
+class CheckSink(KnovaMultiTool):
+    def __init__(self, name, upstream):
+        super().__init__({"name": name, "type": "checksink",
+                          "upstreamconn": upstream})
+        self.got = [] # (origin name, first state value, clock time)
+
+    def propagate(self, origin):
+        self.got.append((origin.name, origin.state[0], KnovaTool.clock.time()))
+
+
+# upstream tool whose state is set by the check
+class CheckSource(KnovaMultiTool):
+    def __init__(self, name, n=1):
+        super().__init__({"name": name, "type": "checksource", "filterms": 0})
+        self.state = array.array("f", [0.0]*n)
+
+    def set(self, *vals):
+        for i in range(len(vals)):
+            self.state[i] = vals[i]
+        self.propagate(None)
+
+
+# web request with the query of the check, records the answer
+class CheckRequest:
+    def __init__(self, **query):
+        self.querydict = query
+        self.code = None
+
+    def senderror(self, code):
+        self.code = code
+
+    def sendemptyresponse(self):
+        self.code = 200
+
+    def sendresponse(self, ctype, body):
+        self.code = 200
+        self.body = body
+
+    def sendheader(self, ctype):
+        self.code = 200
+        self.body = ""
+        return True
+
+    def sendpart(self, part):
+        self.body += part
+        return True
+
+    def sendend(self):
+        pass
+
+
+def reset():
+    # forget the tools of a previous check
+    KnovaTool.unitlist.clear()
+    KnovaTool.lptimer.rtlist.clear()
+    KnovaTool.lptimer.mslist.clear()
+    KnovaTool.scheduler = None
+    KnovaTool.lptimer.dispatch = None
+    KnovaTool.steplist.clear()
+    ai = knova.KnovaAnalogInput # shared sampling timer
+    if ai.adctimer is not None: ai.adctimer.deinit()
+    ai.adctimer = None
+    ai.tickms = 0
+    ai.active.clear()
+    KnovaTool.timercount = 1
+    KnovaTool.setclock(knova.KnovaClock())
+
+
+def update(tool):
+    # a periodic update and the steps it queued, run to the end as the
+    # main loop would
+    tool.periodicupdate()
+    while len(KnovaTool.steplist) > 0:
+        KnovaTool.runstep()
+
+
+def check_history_levels():
+    # raw ring of the last values, 10 minute and hourly min/avg/max with
+    # the current partial bucket at the end
+    reset()
+    hist = knova.KnovaHistory(1, (3, 4, 2))
+    for t in range(0, 1400, 100):
+        hist.add(t, (t/100,))
+    res = {}
+    for lev in ("raw", "10m", "1h"):
+        req = CheckRequest()
+        hist.send(req, lev)
+        res[lev] = knova.ujson.loads(req.body)["data"]
+    assert res["raw"] == [[1100, 11.0], [1200, 12.0], [1300, 13.0]], res["raw"]
+    assert res["10m"] == [[0, 0.0, 2.5, 5.0], [600, 6.0, 8.5, 11.0],
+                          [1200, 12.0, 12.5, 13.0]], res["10m"]
+    assert res["1h"] == [[0, 0.0, 6.5, 13.0]], res["1h"]
+    req = CheckRequest()
+    hist.send(req, "1d")
+    assert req.code == 404
+
+
+def check_regulator_aggregate():
+    # avg and max of the inputs, updated one input at a time; repeated
+    # transitions all propagate, the repetition filter is off by default
+    reset()
+    srcs = [CheckSource("rgsrc%d" % i) for i in range(3)]
+    names = [src.name for src in srcs]
+    avg = KnovaDispatcher({"name": "rgavg", "type": "regulator", "thresh": 20,
+                           "inputop": "avg", "upstreamconn": names, "filterms": 0})
+    mx = KnovaDispatcher({"name": "rgmax", "type": "regulator", "thresh": 20,
+                          "inputop": "max", "upstreamconn": names, "filterms": 0})
+    sink = CheckSink("rgsink", ["rgavg", "rgmax"])
+    KnovaTool.connectall()
+    for src, v in zip(srcs, (10.0, 15.0, 20.0)):
+        src.set(v)
+    assert avg.val == 15.0 and mx.val == 20.0, (avg.val, mx.val)
+    srcs[0].set(40.0) # avg 25, max 40
+    assert avg.val == 25.0 and mx.val == 40.0 and avg.state[0] == 0
+    srcs[0].set(10.0)
+    srcs[0].set(40.0)
+    assert [g[0] for g in sink.got if g[0] == "rgavg"] == ["rgavg"]*4, sink.got
+    reset()
+    none = KnovaDispatcher({"name": "rgnone", "type": "regulator", "thresh": 20,
+                            "inputop": "avg", "filterms": 0})
+    try:
+        KnovaTool.connectall()
+    except ValueError:
+        pass
+    else:
+        assert False, "regulator avg without inputs accepted"
+
+
+def check_threshold_exact():
+    # without hysteresis a level is up at val >= thresh and down at
+    # val <= thresh, so landing exactly on it switches the level, from
+    # either side, and leaving it switches it back
+    reset()
+    src = CheckSource("thsrc")
+    bank = KnovaDispatcher({"name": "th", "type": "thresholdbank",
+                            "upstreamconn": ["thsrc"], "thresh": [20, 25],
+                            "filterms": 0})
+    KnovaTool.connectall()
+    src.set(20.0) # first value on the threshold
+    assert list(bank.above) == [1, 0], list(bank.above)
+    for seq, expect in (((19.0,), [0, 0]), ((20.0,), [1, 0]), ((19.0,), [0, 0]),
+                        ((25.0, 24.0, 25.0), [1, 1]), ((20.0,), [0, 0]),
+                        ((21.0,), [1, 0]), ((30.0, 19.0), [0, 0])):
+        for v in seq:
+            src.set(v)
+        assert list(bank.above) == expect, (seq, list(bank.above), expect)
+    assert list(bank.state) == [1, 1] # levels output 1 below threshold
+    for level in ("-1", "2", "x"): # no wrap to the last levels
+        req = CheckRequest(level=level, value="10")
+        bank.setthresh(req)
+        assert req.code == 400, level
+    assert list(bank.thresh) == [20, 25]
+    req = CheckRequest(level="1", value="18")
+    bank.setthresh(req)
+    assert req.code == 200 and list(bank.above) == [0, 1]
+
+
+def check_threshold_levels():
+    # more levels than a byte can index
+    reset()
+    src = CheckSource("thsrc")
+    n = 300
+    bank = KnovaDispatcher({"name": "th", "type": "thresholdbank",
+                            "upstreamconn": ["thsrc"], "thresh": list(range(n)),
+                            "filterms": 0})
+    KnovaTool.connectall()
+    src.set(-1.0)
+    src.set(n - 0.5)
+    assert sum(bank.above) == n
+    src.set(279.5)
+    assert sum(bank.above) == 280 and bank.above[279] and not bank.above[280]
+
+
+def check_timer_order():
+    # rtlist stays sorted whatever the insertion order, a timer later
+    # than all the queued ones goes last
+    reset()
+    lpt = KnovaTool.lptimer
+    for delta in (50, 10, 30, 100, 20, 200, 5, 200):
+        lpt.addtimer(delta, reset)
+    times = [t[0] for t in lpt.rtlist]
+    assert times == sorted(times), times
+    lpt.rtlist.clear()
+
+
+def check_scheduler_nodrop():
+    # timer callbacks past the queue depth are all run, not dropped
+    reset()
+    sch = KnovaDispatcher({"name": "sch", "type": "scheduler", "queuedepth": 2})
+    done = []
+    for i in range(6):
+        KnovaTool.lptimer.addtimerms(0, lambda i=i: done.append(i))
+    KnovaTool.lptimer.checktimer()
+    sch.run()
+    assert sorted(done) == list(range(6)), done
+    rep = sch.report()["actuator"]
+    assert rep["dropped"] == 0 and rep["overflow"] == 4, rep
+
+
+def check_scheduler_priorities():
+    # timers due together run by class, input first; a class waiting
+    # past its budget goes before the higher ones
+    reset()
+    sim = KnovaSimulator(2)
+    KnovaTool.setclock(sim.clock)
+    sch = KnovaDispatcher({"name": "sch", "type": "scheduler"})
+    order = []
+    for prio in (3, 2, 1, 0, 3, 0):
+        KnovaTool.lptimer.addtimer(1, lambda p=prio: order.append(p), prio=prio)
+    sim.run()
+    assert order == [0, 0, 1, 2, 3, 3], order
+    order.clear()
+    sch.post(3, order.append, "sensor")
+    sim.clock.sleep(6) # over the 5 s wait budget of sensors
+    sch.post(2, order.append, "web")
+    sch.post(0, order.append, "input")
+    sch.run()
+    assert order == ["sensor", "input", "web"], order
+    assert sch.report()["sensor"]["waitmiss"] == 1
+
+
+def check_schedule_queue():
+    # the emulation of micropython.schedule: callbacks run in order at
+    # the next safe point, a full queue raises RuntimeError
+    import sched
+    sched.setdepth(3)
+    done = []
+    for i in range(3):
+        sched.schedule(done.append, i)
+    try:
+        sched.schedule(done.append, 3)
+    except RuntimeError:
+        pass
+    else:
+        assert False, "full schedule queue accepted a callback"
+    assert done == []
+    sched.runpending()
+    assert done == [0, 1, 2] and sched.stats()["dropped"] == 1, sched.stats()
+    sched.setdepth(4)
+    sched.resetstats()
+
+
+def check_virtual_time():
+    # the scheduler measures run time on the injected clock, and the
+    # CPython ticks emulation leaves the time module alone
+    import sys
+    import time
+    reset()
+    sim = KnovaSimulator(1)
+    KnovaTool.setclock(sim.clock)
+    sch = KnovaDispatcher({"name": "sch", "type": "scheduler"})
+    sch.post(1, sim.clock.sleep, 0.03) # 30 virtual ms, over the 20 ms budget
+    sch.post(1, sim.clock.sleep, 0.001)
+    sch.run()
+    rep = sch.report()["actuator"]
+    assert rep["run"] == 2 and rep["runmiss"] == 1 and rep["maxrun"] == 30, rep
+    if sys.implementation.name != "micropython":
+        assert not hasattr(time, "ticks_ms")
+
+
+def check_analog_shared_timer():
+    # analog inputs share a hardware timer ticking at the gcd of their
+    # sample periods, each completes its window at its own period
+    reset()
+    sim = KnovaSimulator(3)
+    KnovaTool.setclock(sim.clock)
+    ai = []
+    for pin, period, level in ((32, 10, 0.5), (33, 15, 0.25)):
+        ai.append(KnovaDispatcher({"name": "ai%d" % len(ai), "type": "analoginput",
+                                   "pin": pin, "sampleperiod": period, "nsamples": 4,
+                                   "updateperiod": 1, "scale": 1/65535}))
+        ai[-1].pin.setinput(level)
+    sink = CheckSink("aisink", ["ai0", "ai1"])
+    KnovaTool.connectall()
+    KnovaTool.activateall()
+    sim.run()
+    assert KnovaTool.timercount == 2 and knova.KnovaAnalogInput.tickms == 5
+    assert [(g[0], round(g[1], 3), g[2]) for g in sink.got] == \
+        [("ai0", 0.5, 1), ("ai1", 0.25, 1), ("ai0", 0.5, 2), ("ai1", 0.25, 2)], sink.got
+
+
+def check_expression_divzero():
+    # a divisor reading 0 keeps the previous output
+    reset()
+    a = CheckSource("exa")
+    b = CheckSource("exb")
+    ex = KnovaDispatcher({"name": "ex", "type": "expression", "expr": "exa / exb",
+                          "output": "value", "filterms": 0})
+    KnovaTool.connectall()
+    a.set(6.0)
+    b.set(3.0)
+    assert ex.state[0] == 2.0, ex.state[0]
+    b.set(0.0)
+    assert ex.state[0] == 2.0, ex.state[0]
+
+
+def check_cache_errors():
+    # a failed read keeps the last value and is retried after ttl, a
+    # stale value is revalidated by a timer, never propagated as new
+    reset()
+    sim = KnovaSimulator(1)
+    KnovaTool.setclock(sim.clock)
+    vals = [OSError(), 1.0, OSError(), OSError(), 2.0]
+    def read():
+        v = vals.pop(0)
+        if isinstance(v, OSError): raise v
+        return v
+    cache = knova.KnovaCachedRead(KnovaTool.lptimer, read, 1000, 2000)
+    got = []
+    def get():
+        got.append((cache.get(), cache.seq, cache.errors, cache.failed))
+    for ms in (0, 500, 1100, 1600, 2500, 3500, 4000):
+        sim.clock.after(ms*1000, get)
+    sim.duration = 5
+    sim.run()
+    assert got == [(None, 0, 1, True),   # nothing read yet
+                   (None, 0, 1, True),   # failure kept for ttl
+                   (1.0, 1, 1, False),   # retried after ttl
+                   (1.0, 1, 1, False),   # fresh
+                   (1.0, 1, 1, False),   # stale, revalidation queued
+                   (1.0, 1, 2, True),    # that failed, stale again
+                   (1.0, 1, 3, True)], got # failed again, value kept
+    assert cache.age() == 3900, cache.age()
+    sim.clock.sleep(3.5) # too old, read at once
+    assert cache.get() == 2.0 and cache.seq == 2 and cache.age() == 0
+
+
+def check_inputbank_debounce():
+    # a line changes after 4 stable scans: a bouncing press gives a
+    # single event, a glitch shorter than the debounce time none
+    reset()
+    sim = KnovaSimulator(0.11)
+    KnovaTool.setclock(sim.clock)
+    ib = KnovaDispatcher({"name": "ib", "type": "inputbank", "pins": [4, 5],
+                          "scanms": 5})
+    sink = CheckSink("ibsink", ["ib.0", "ib.1"])
+    KnovaTool.connectall()
+    KnovaTool.activateall()
+    p0, p1 = ib.pins
+    for k in range(7): # bounces every ms from 100 ms, settles at 1
+        sim.clock.after(100000 + k*1000, lambda v=(k + 1) & 1: p0.setinput(v))
+    sim.clock.after(300000, lambda: p1.setinput(1)) # 8 ms glitch
+    sim.clock.after(308000, lambda: p1.setinput(0))
+    sim.run()
+    assert sink.got == [] and list(ib.state) == [0, 0] # still bouncing
+    sim.duration = 0.04
+    sim.run() # 150 ms
+    assert [g[:2] for g in sink.got] == [("ib.0", 1)], sink.got
+    sim.duration = 0.5
+    sim.run()
+    assert len(sink.got) == 1 and list(ib.state) == [1, 0], (sink.got, list(ib.state))
+
+
+def check_owthermometer_lost():
+    # a DS18B20 missing from a DS248x round is an error of its cache, its
+    # last value is not propagated again and no blocking read is tried
+    import os
+    import binascii
+    reset()
+    sim = KnovaSimulator(9)
+    KnovaTool.setclock(sim.clock)
+    i2c = machine.I2C(0)
+    dev = i2c.attach(24, machine.DS248xDevice(i2c))
+    sensors = [dev.add(machine.OneWireDS18B20(1, 21.5)),
+               dev.add(machine.OneWireDS18B20(2, 30.0))]
+    newi2c = machine.I2C
+    machine.I2C = lambda *args, **kw: i2c # the bus of the emulated adapter
+    try:
+        bus = KnovaDispatcher({"name": "owb", "type": "owi2cbus", "pin": [1, 2],
+                               "updateperiod": 2, "romfile": "checkroms.json"})
+    finally:
+        machine.I2C = newi2c
+    th = []
+    for sensor in sensors:
+        th.append(KnovaDispatcher({"name": "ow%d" % len(th), "type": "owthermometer",
+                                   "romid": binascii.hexlify(sensor.rom).decode(),
+                                   "upstreamconn": ["owb"], "cachettl": 0}))
+    sink = CheckSink("owsink", ["ow0", "ow1"])
+    try:
+        KnovaTool.connectall()
+        KnovaTool.activateall()
+        sim.run()
+        assert [g[:2] for g in sink.got[-2:]] in ([("ow0", 21.5), ("ow1", 30.0)],
+                                                   [("ow1", 30.0), ("ow0", 21.5)]), sink.got
+        dev.buses[0].remove(sensors[1])
+        n = len(sink.got)
+        sim.duration = 6
+        sim.run()
+        assert [g[0] for g in sink.got[n:]] == ["ow0"]*3, sink.got[n:]
+        assert th[1].cache.failed and th[1].cache.errors > 0
+        assert th[1].state[0] == 30.0 # last good value kept for the web
+        assert th[0].cache.errors == 0
+        assert sim.stats()["cpuus"] < 2000000 # no 750 ms blocking reads
+    finally:
+        try:
+            os.remove("checkroms.json")
+        except OSError:
+            pass
+
+
+def check_opentherm():
+    # the opentherm tool against the otgateway stand-in: the dirty fields
+    # go in one post, the machine state is parsed, failures back off
+    from otgateway import OpenThermGateway
+    reset()
+    gw = OpenThermGateway()
+    try:
+        src = CheckSource("otsrc", 2)
+        ot = KnovaDispatcher({"name": "ot", "type": "opentherm",
+                              "host": "127.0.0.1", "port": gw.port,
+                              "updateperiod": 10, "maxbackoff": 80,
+                              "writes": {"chust": "otsrc", "roomstp": "otsrc[1]"}})
+        KnovaTool.connectall()
+        src.set(1, 20.0)
+        src.set(3, 21.5) # only the last values are sent
+        ot.periodicupdate() # queued for the main loop, not run inline
+        assert ot.busy and len(KnovaTool.steplist) == 1 and gw.sets == []
+        ot.periodicupdate() # no second cycle while one is running
+        assert len(KnovaTool.steplist) == 1
+        while len(KnovaTool.steplist) > 0:
+            KnovaTool.runstep()
+        assert gw.sets == ["chust=3&roomstp=21.5"], gw.sets
+        assert list(ot.dirty) == [0]*len(ot.dirty), list(ot.dirty)
+        assert ot.online and ot.sets == 1 and ot.polls == 1
+        fields = ot.fields
+        assert ot.state[fields.index("mchon")] == 1.0, list(ot.state)
+        assert ot.state[fields.index("flame")] == 1.0, list(ot.state)
+        assert ot.state[fields.index("mchwstp")] == 45.0, list(ot.state)
+        update(ot) # nothing dirty, a poll only
+        assert len(gw.sets) == 1 and ot.polls == 2
+        gw.fail = 100
+        src.set(0, 22.0)
+        skips = []
+        for i in range(8):
+            update(ot)
+            skips.append(ot.skip)
+        # 1, 2, 4 skipped polls, capped by maxbackoff/updateperiod - 1
+        assert skips == [1, 0, 2, 1, 0, 4, 3, 2], skips
+        assert ot.failures == 3 and not ot.online and ot.backoff == 4
+        assert list(ot.dirty)[:3] == [1, 0, 1], list(ot.dirty) # kept to resend
+        gw.fail = 0
+        for i in range(5):
+            update(ot)
+        assert ot.online and ot.backoff == 0 and ot.skip == 0
+        assert gw.sets[-1] == "chust=0&roomstp=22.0", gw.sets
+        assert ot.state[fields.index("flame")] == 0.0, list(ot.state)
+    finally:
+        KnovaTool.http.close()
+        gw.close()
+
+
+checks = [check_history_levels, check_regulator_aggregate,
+          check_threshold_exact, check_threshold_levels, check_timer_order,
+          check_scheduler_nodrop, check_scheduler_priorities,
+          check_schedule_queue, check_virtual_time, check_expression_divzero,
+          check_opentherm, check_owthermometer_lost,
+          check_analog_shared_timer, check_cache_errors,
+          check_inputbank_debounce]
+
+
+if __name__ == '__main__':
+    for check in checks:
+        check()
+        print("ok", check.__name__)
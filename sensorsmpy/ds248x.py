@@ -26,7 +26,11 @@ Implementation Notes
 
 import time
 from machine import I2C, Pin
-from micropython import const
+try:
+    from micropython import const
+    from time import sleep_us, ticks_ms, ticks_diff
+except ImportError: # CPython, emulated const and time ticks
+    from sched import const, sleep_us, ticks_ms, ticks_diff
 
 # DS248x Command Definitions
 _RESET = const(0xF0)
@@ -43,6 +47,14 @@ _CHANNEL_SELECT = const(0xC3)
 _REG_STATUS = const(0xF0)
 _REG_READ_DATA = const(0xE1)
 _REG_CONFIG = const(0xC3)
+_REG_CHANNEL = const(0xD2)
+
+# DS248x Configuration Bits
+_CONFIG_APU = const(0x01)
+
+# 1-Wire Timings at Standard Speed (us)
+_T_RESET = const(1148)
+_T_SLOT = const(72)
 
 # DS18B20 Commands
 _DS18B20_FAMILY = const(0x28)
@@ -50,18 +62,64 @@ _DS18B20_T = const(0x44)
 _DS18B20_ROM = const(0x55)
 _DS18B20_SCRATCHPAD = const(0xBE)
 
+# DS2482-800 Channel Select Return Codes
+_CHANNEL_CODES = (0xB8, 0xB1, 0xAA, 0xA3, 0x9C, 0x95, 0x8E, 0x87)
+
+
+def _crc8_table() -> bytes:
+    """
+    Build the lookup table of the Dallas/Maxim 1-Wire CRC8, one entry per
+    byte value, so that the CRC costs one lookup per byte.
+
+    :return: The 256 bytes table
+    """
+    table = bytearray(256)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 0x01:
+                crc = (crc >> 1) ^ 0x8C
+            else:
+                crc >>= 1
+        table[i] = crc
+    return bytes(table)
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+def _crc8(data, length: int) -> int:
+    """
+    Dallas/Maxim 1-Wire CRC8 of the first bytes of a buffer.
+
+    :param data: The buffer
+    :param length: The number of bytes to include
+    :return: The CRC, 0 if the buffer includes a matching CRC byte
+    """
+    crc = 0
+    table = _CRC8_TABLE
+    for i in range(length):
+        crc = table[crc ^ data[i]]
+    return crc
+
 
 class DS248x:
     """
     Driver for the DS248x 1-Wire to I2C Bus Adapter.
     """
 
-    def __init__(self, i2c, address: int = 0x18):
+    def __init__(self, i2c, address: int = 0x18, config: int = _CONFIG_APU,
+                 verify_crc: bool = True, crc_retries: int = 2):
         """
         Initialize the DS248x driver.
 
         :param i2c: An instance of micropython I2C or SoftI2c classes
         :param address: The I2C address of the DS248x device
+        :param config: The configuration written after reset, active
+                       pullup at standard speed by default
+        :param verify_crc: Read the whole DS18B20 scratchpad and check its
+                           CRC, otherwise read only the 2 temperature bytes
+        :param crc_retries: The number of further reads after a CRC error
         """
         try:
             self.i2c_device = i2c
@@ -70,11 +128,29 @@ class DS248x:
             else:
                 raise RuntimeError("Requested I2C address not found on bus")
             self._selected_channel = -1
+            self.i2c_transactions: int = 0
+            self.i2c_ops = {} # operation name: [calls, i2c transactions]
+            self._read_ptr = -1 # register the read pointer is on, if known
+            self._status = 0xFF # last status read
+            self._busy = True # a 1-Wire command may still be running
             self.rom_no: bytearray = bytearray(8)
+            # preallocated command and reply buffers, nothing is allocated
+            # per operation once the driver is initialized
+            self._cmdbuf = bytearray(2)
+            self._cmd1 = memoryview(self._cmdbuf)[:1]
+            self._cmd2 = memoryview(self._cmdbuf)
+            self._reply = bytearray(1)
+            self._scratchpad = bytearray(9)
+            self.verify_crc = verify_crc
+            self.crc_retries = crc_retries
+            self.crc_errors: int = 0 # reads with a wrong CRC
+            self.read_retries: int = 0 # reads repeated after an error
+            self.read_failures: int = 0 # reads given up
             self.last_discrepancy: int = 0
             self.last_device_flag: bool = False
             self.last_family_discrepancy: int = 0
             self.reset()
+            self.config = config
             while not self.onewire_reset():
                 print("Failed to do a 1W reset")
                 if self.short_detected:
@@ -91,9 +167,14 @@ class DS248x:
 
         :return: True if the reset was successful, False otherwise
         """
-        cmd = bytearray([_RESET])
-        self.i2c_device.writeto(self.address, cmd)
+        start = self.i2c_transactions
+        self._write(self._command(_RESET))
+        # the DS2482-800 is back on channel 0, set both again when needed
+        self._selected_channel = -1
+        self._read_ptr = -1
+        self._busy = True
         status = self.status
+        self._account("reset", start)
         return (status != 0xFF) and (status & 0x10)
 
     def onewire_reset(self) -> bool:
@@ -102,10 +183,11 @@ class DS248x:
 
         :return: True if the reset was successful, False otherwise
         """
+        start = self.i2c_transactions
         self._busy_wait(1000)
-        cmd = bytearray([_1WIRE_RESET])
-        self.i2c_device.writeto(self.address, cmd)
-        status = self.status
+        self._onewire_command(self._command(_1WIRE_RESET))
+        status = self._poll_status(1000, _T_RESET)
+        self._account("onewire_reset", start)
         return (status != 0xFF) and not self.short_detected and self.presence_pulse_detected
 
     @property
@@ -115,21 +197,22 @@ class DS248x:
 
         :return: The byte read from the 1-Wire bus
         """
+        start = self.i2c_transactions
         self._busy_wait(1000)
-        cmd = bytearray([_1WIRE_READ_BYTE])
-        self.i2c_device.writeto(self.address, cmd)
-        self._busy_wait(1000)
+        self._onewire_command(self._command(_1WIRE_READ_BYTE))
+        self._poll_status(1000, 8 * _T_SLOT)
         self._set_read_pointer(_REG_READ_DATA)
-        read_buffer = bytearray(1)
-        self.i2c_device.readfrom_into(self.address, read_buffer)
-        return read_buffer[0]
+        self._read_into(self._reply)
+        self._account("onewire_byte_read", start)
+        return self._reply[0]
 
     @onewire_byte.setter
     def onewire_byte(self, byte: int) -> None:
+        start = self.i2c_transactions
         self._busy_wait(1000)
-        cmd = bytearray([_1WIRE_WRITE_BYTE, byte])
-        self.i2c_device.writeto(self.address, cmd)
-        self._busy_wait(1000)
+        self._onewire_command(self._command(_1WIRE_WRITE_BYTE, byte))
+        self._poll_status(1000, 8 * _T_SLOT)
+        self._account("onewire_byte_write", start)
 
     @property
     def onewire_bit(self) -> bool:
@@ -138,16 +221,16 @@ class DS248x:
 
         :param bit: The bit to write to the 1-Wire bus
         """
-        self._busy_wait(1000)
         self.onewire_bit = 1
-        self._busy_wait(1000)
         return self.single_bit_result
 
     @onewire_bit.setter
     def onewire_bit(self, bit: int) -> None:
+        start = self.i2c_transactions
         self._busy_wait(1000)
-        cmd = bytearray([_1WIRE_SINGLE_BIT, 0x80 if bit else 0x00])
-        self.i2c_device.writeto(self.address, cmd)
+        self._onewire_command(self._command(_1WIRE_SINGLE_BIT, 0x80 if bit else 0x00))
+        self._poll_status(1000, _T_SLOT)
+        self._account("onewire_bit", start)
 
     def onewire_search_reset(self) -> None:
         """
@@ -157,9 +240,97 @@ class DS248x:
         self.last_device_flag = False
         self.last_family_discrepancy = 0
 
+    def onewire_triplet(self, direction: int) -> int:
+        """
+        Generate a 1-Wire triplet: read a bit and its complement and write
+        the search direction, which the DS248x chooses by itself unless
+        both bits are 0.
+
+        :param direction: The direction to take if both bits read are 0
+        :return: The status byte, see `single_bit_result`,
+                 `triplet_second_bit` and `branch_dir_taken`
+        """
+        self._busy_wait(1000)
+        self._onewire_command(self._command(_TRIPLET, 0x80 if direction else 0x00))
+        return self._poll_status(1000, 3 * _T_SLOT)
+
     def onewire_search(self, new_addr) -> bool: # new_addr: List[int]
         """
-        Perform a 1-Wire search to find devices on the bus.
+        Perform a 1-Wire search to find devices on the bus, using the
+        triplet command so that each ROM bit costs one I2C write and
+        usually a single status read.
+
+        :param new_addr: The list to store the address of the found device
+        :return: True if a device was found, False otherwise
+        """
+        start = self.i2c_transactions
+        search_result = False
+        id_bit_number = 1
+        last_zero = 0
+        rom_byte_number = 0
+        rom_byte_mask = 1
+
+        if not self.last_device_flag:
+            if not self.onewire_reset():
+                self.last_discrepancy = 0
+                self.last_device_flag = False
+                self.last_family_discrepancy = 0
+                return False
+
+            self.onewire_byte = 0xF0
+
+            while rom_byte_number < 8:
+                if id_bit_number < self.last_discrepancy:
+                    search_direction = (self.rom_no[rom_byte_number] & rom_byte_mask) > 0
+                else:
+                    search_direction = id_bit_number == self.last_discrepancy
+
+                status = self.onewire_triplet(search_direction)
+                id_bit = status & 0x20
+                cmp_id_bit = status & 0x40
+                search_direction = status & 0x80
+
+                if id_bit and cmp_id_bit:
+                    break
+                if not id_bit and not cmp_id_bit and not search_direction:
+                    last_zero = id_bit_number
+                    if last_zero < 9:
+                        self.last_family_discrepancy = last_zero
+
+                if search_direction:
+                    self.rom_no[rom_byte_number] |= rom_byte_mask
+                else:
+                    self.rom_no[rom_byte_number] &= ~rom_byte_mask
+
+                id_bit_number += 1
+                rom_byte_mask <<= 1
+
+                if rom_byte_mask == 0x100:
+                    rom_byte_number += 1
+                    rom_byte_mask = 1
+
+            if id_bit_number >= 65:
+                self.last_discrepancy = last_zero
+                if self.last_discrepancy == 0:
+                    self.last_device_flag = True
+                search_result = True
+
+        if not search_result or not self.rom_no[0]:
+            self.last_discrepancy = 0
+            self.last_device_flag = False
+            self.last_family_discrepancy = 0
+            search_result = False
+
+        for i in range(8):
+            new_addr[i] = self.rom_no[i]
+        self._account("onewire_search", start)
+        return search_result
+
+    def onewire_search_bitwise(self, new_addr) -> bool: # new_addr: List[int]
+        """
+        Perform a 1-Wire search to find devices on the bus, generating
+        each ROM bit with single bit commands. Slower than `onewire_search`,
+        kept for adapters or tests without the triplet command.
 
         :param new_addr: The list to store the address of the found device
         :return: True if a device was found, False otherwise
@@ -229,17 +400,42 @@ class DS248x:
             new_addr[i] = self.rom_no[i]
         return search_result
 
+    def onewire_verify(self, rom) -> bool:
+        """
+        Check that a device is present on the bus with a search targeted
+        at its ROM address, the state of an ongoing search is preserved.
+
+        :param rom: The ROM address of the device
+        :return: True if the device answered, False otherwise
+        """
+        saved = (bytearray(self.rom_no), self.last_discrepancy,
+                 self.last_device_flag, self.last_family_discrepancy)
+        for i in range(8):
+            self.rom_no[i] = rom[i]
+        self.last_discrepancy = 64
+        self.last_device_flag = False
+        found = bytearray(8)
+        result = self.onewire_search(found) and found == rom
+        self.rom_no[:] = saved[0]
+        self.last_discrepancy, self.last_device_flag, \
+            self.last_family_discrepancy = saved[1:]
+        return result
+
     @property
     def status(self) -> int:
         """
-        Status of the DS248x device.
+        Status of the DS248x device, read from the device. The flag
+        properties below refer to the last status read.
 
         :return: The status byte of the DS248x device
         """
         self._set_read_pointer(_REG_STATUS)
-        status = bytearray(1)
-        self.i2c_device.readfrom_into(self.address, status)
-        return status[0]
+        self._read_into(self._reply)
+        status = self._reply[0]
+        self._status = status
+        if not status & 0x01:
+            self._busy = False
+        return status
 
     @property
     def config(self) -> int:
@@ -249,16 +445,15 @@ class DS248x:
         :return: The configuration byte of the DS248x device
         """
         self._set_read_pointer(_REG_CONFIG)
-        config = bytearray(1)
-        self.i2c_device.readfrom_into(self.address, config)
-        return config[0]
+        self._read_into(self._reply)
+        return self._reply[0]
 
     @config.setter
     def config(self, value: int) -> None:
         self._busy_wait(1000)
         config_value = (value & 0x0F) | ((~value & 0x0F) << 4)
-        cmd = bytearray([_WRITE_CONFIG, config_value])
-        self.i2c_device.writeto(self.address, cmd)
+        self._write(self._command(_WRITE_CONFIG, config_value))
+        self._read_ptr = _REG_CONFIG
 
     def _set_read_pointer(self, reg: int) -> None:
         """
@@ -266,18 +461,104 @@ class DS248x:
 
         :param reg: The register address to set the read pointer to
         """
-        cmd = bytearray([_READ_PTR, reg])
-        self.i2c_device.writeto(self.address, cmd)
+        if reg == self._read_ptr:
+            return
+        self._write(self._command(_READ_PTR, reg))
+        self._read_ptr = reg
+
+    def _write(self, buf) -> None:
+        """
+        Write a command to the device, counting I2C transactions.
+
+        :param buf: The command bytes
+        """
+        self.i2c_transactions += 1
+        self.i2c_device.writeto(self.address, buf)
+
+    def _read_into(self, buf) -> None:
+        """
+        Read from the register the read pointer is set to, counting I2C
+        transactions.
+
+        :param buf: The buffer to fill
+        """
+        self.i2c_transactions += 1
+        self.i2c_device.readfrom_into(self.address, buf)
+
+    def _command(self, cmd: int, arg: int = -1) -> memoryview:
+        """
+        Fill the preallocated command buffer.
+
+        :param cmd: The command code
+        :param arg: The command argument byte, none if negative
+        :return: A view of the buffer with the command to be sent
+        """
+        self._cmdbuf[0] = cmd
+        if arg < 0:
+            return self._cmd1
+        self._cmdbuf[1] = arg
+        return self._cmd2
+
+    def _onewire_command(self, cmd) -> None:
+        """
+        Send a 1-Wire command, which leaves the read pointer on the status
+        register and the bus busy until it completes.
+
+        :param cmd: The command bytes
+        """
+        self._write(cmd)
+        self._read_ptr = _REG_STATUS
+        self._busy = True
+
+    def _poll_status(self, timeout_ms: int, expect_us: int = 0) -> int:
+        """
+        Wait for the expected duration of the running 1-Wire command, then
+        read the status register until the bus is not busy, so that
+        usually a single read is needed.
+
+        :param timeout_ms: The timeout in milliseconds
+        :param expect_us: The expected duration of the command
+        :return: The status byte
+        :raises RuntimeError: If the bus is still busy after the timeout
+        """
+        if expect_us > 0:
+            sleep_us(expect_us)
+        start = ticks_ms()
+        while True:
+            status = self.status
+            if not status & 0x01:
+                return status
+            if ticks_diff(ticks_ms(), start) >= timeout_ms:
+                raise RuntimeError("Bus is busy after timeout")
+
+    def _account(self, op: str, start: int) -> None:
+        """
+        Add the I2C transactions done since start to the counters of an
+        operation, nested operations are included in the outer ones.
+
+        :param op: The operation name
+        :param start: The value of i2c_transactions when the operation started
+        """
+        counts = self.i2c_ops.get(op)
+        if counts is None:
+            counts = [0, 0]
+            self.i2c_ops[op] = counts
+        counts[0] += 1
+        counts[1] += self.i2c_transactions - start
 
     def _busy_wait(self, timeout_ms: int) -> None:
         """
         Wait until the 1-Wire bus is not busy or until a timeout occurs.
+        Nothing is read if the last status showed the bus idle and no
+        1-Wire command was sent since.
 
         :param timeout_ms: The timeout in milliseconds
         :raises RuntimeError: If the bus is still busy after the timeout
         """
-        start = time.ticks_ms()
-        while (time.ticks_diff(time.ticks_ms(), start)) < timeout_ms:
+        if not self._busy:
+            return
+        start = ticks_ms()
+        while (ticks_diff(ticks_ms(), start)) < timeout_ms:
             if not self.onewire_busy:
                 return
             time.sleep(0.001)
@@ -296,31 +577,31 @@ class DS248x:
     @property
     def presence_pulse_detected(self) -> bool:
         """
-        Check if a presence pulse is detected on the 1-Wire bus.
+        Check if a presence pulse was detected, as of the last status read.
 
         :return: True if a presence pulse is detected, False otherwise
         """
-        status = self.status
+        status = self._status
         return status != 0xFF and (status & 0x02)
 
     @property
     def short_detected(self) -> bool:
         """
-        Check if a short circuit is detected on the 1-Wire bus.
+        Check if a short circuit was detected, as of the last status read.
 
         :return: True if a short circuit is detected, False otherwise
         """
-        status = self.status
+        status = self._status
         return status != 0xFF and (status & 0x04)
 
     @property
     def logic_level(self) -> bool:
         """
-        Check the logic level of the 1-Wire bus.
+        Check the logic level of the 1-Wire bus, as of the last status read.
 
         :return: True if the logic level is high, False if it is low
         """
-        status = self.status
+        status = self._status
         return status != 0xFF and (status & 0x08)
 
     @property
@@ -330,7 +611,7 @@ class DS248x:
 
         :return: True if the result bit is 1, False if it is 0
         """
-        status = self.status
+        status = self._status
         return bool(status & 0x20)
 
     @property
@@ -340,7 +621,7 @@ class DS248x:
 
         :return: True if the second bit is 1, False if it is 0
         """
-        status = self.status
+        status = self._status
         return status != 0xFF and (status & 0x40)
 
     @property
@@ -350,7 +631,7 @@ class DS248x:
 
         :return: True if the branch direction was taken, False otherwise
         """
-        status = self.status
+        status = self._status
         return status != 0xFF and (status & 0x80)
 
     def ds18b20_temperature(self, rom: bytearray = None) -> float:
@@ -364,34 +645,130 @@ class DS248x:
         if rom:
             if rom[0] != _DS18B20_FAMILY:
                 raise ValueError("Device attached is not a DS18B20")
-            # Match ROM if a ROM address is provided
-            self.onewire_reset()
-            self.onewire_byte = 0x55
-            for byte in rom:
-                self.onewire_byte = byte
+        self._select_rom(rom)
+        self.onewire_byte = _DS18B20_T
+        time.sleep(0.75)
+        return self.ds18b20_read_temperature(rom)
+
+    def ds18b20_convert_all(self) -> None:
+        """
+        Start a temperature conversion on all the DS18B20 sensors of the bus
+        at once with a Skip ROM command. Results can be read with
+        `ds18b20_read_temperature` after the conversion time (750ms at 12 bits).
+        """
+        start = self.i2c_transactions
+        self._select_rom(None)
+        self.onewire_byte = _DS18B20_T
+        self._account("ds18b20_convert_all", start)
+
+    def ds18b20_read_temperature(self, rom: bytearray = None) -> float:
+        """
+        Reads the result of the last conversion from a DS18B20 sensor,
+        without starting a new one.
+
+        :param rom: The ROM address of the DS18B20 sensor (optional)
+        :return: The temperature in Celsius
+        """
+        return self.ds18b20_read_raw(rom) / 16.0
+
+    def ds18b20_read_raw(self, rom: bytearray = None) -> int:
+        """
+        Reads the result of the last conversion from a DS18B20 sensor as
+        a signed integer in 1/16 Celsius, without allocating memory.
+        With `verify_crc` the whole scratchpad is read and checked, with up
+        to `crc_retries` further reads, otherwise only the 2 temperature
+        bytes are read and the transfer is cut with a 1-Wire reset; in this
+        mode 0xFFFF, also sent by a missing sensor, is checked once with
+        `ds18b20_present` before being taken as -0.0625 Celsius.
+
+        :param rom: The ROM address of the DS18B20 sensor (optional)
+        :return: The raw temperature
+        :raises RuntimeError: If no valid answer was read
+        """
+        data = self._scratchpad
+        if self.verify_crc:
+            attempt = 0
+            while True:
+                self.ds18b20_read_scratchpad(rom, data)
+                if _crc8(data, 9) == 0 and (data[4] & 0x1F) == 0x1F:
+                    break
+                self.crc_errors += 1
+                if attempt >= self.crc_retries:
+                    self.read_failures += 1
+                    raise RuntimeError("DS18B20 scratchpad CRC error")
+                attempt += 1
+                self.read_retries += 1
         else:
-            # Skip ROM if no ROM address is provided
-            self.onewire_reset()
-            self.onewire_byte = 0xCC
-        self.onewire_byte = 0x44
+            start = self.i2c_transactions
+            self._select_rom(rom)
+            self.onewire_byte = _DS18B20_SCRATCHPAD
+            data[0] = self.onewire_byte
+            data[1] = self.onewire_byte
+            self.onewire_reset() # stop the sensor sending the rest
+            self._account("ds18b20_read_fast", start)
+            # the check reads the whole scratchpad into data
+            if data[0] == 0xFF and data[1] == 0xFF and not self.ds18b20_present(rom):
+                self.read_failures += 1
+                raise RuntimeError("No answer from DS18B20")
+        raw = (data[1] << 8) | data[0]
+        if raw & 0x8000:
+            raw -= 1 << 16
+        return raw
+
+    def ds18b20_read_scratchpad(self, rom: bytearray, buf) -> bytearray:
+        """
+        Reads the 9 bytes scratchpad of a DS18B20 sensor straight into a
+        caller supplied buffer.
+
+        :param rom: The ROM address of the DS18B20 sensor, None for Skip ROM
+        :param buf: A buffer of at least 9 bytes
+        :return: The buffer
+        """
+        start = self.i2c_transactions
+        self._select_rom(rom)
+        self.onewire_byte = _DS18B20_SCRATCHPAD
+        for i in range(9):
+            buf[i] = self.onewire_byte
+        self._account("ds18b20_read_scratchpad", start)
+        return buf
+
+    def ds18b20_present(self, rom: bytearray) -> bool:
+        """
+        Quick presence check of a DS18B20 sensor: address it with Match ROM
+        and verify the CRC of its scratchpad, cheaper than `onewire_verify`.
+
+        :param rom: The ROM address of the DS18B20 sensor
+        :return: True if the sensor answered with a valid scratchpad
+        """
+        data = self.ds18b20_read_scratchpad(rom, self._scratchpad)
+        return _crc8(data, 9) == 0 and (data[4] & 0x1F) == 0x1F
+
+    def ds18b20_temperatures(self, roms) -> list:
+        """
+        Reads the temperature from many DS18B20 sensors with a single
+        bus-wide conversion, waiting once for all of them.
+
+        :param roms: The ROM addresses of the DS18B20 sensors
+        :return: The temperatures in Celsius, in the same order as roms
+        """
+        self.ds18b20_convert_all()
         time.sleep(0.75)
+        return [self.ds18b20_read_temperature(rom) for rom in roms]
+
+    def _select_rom(self, rom: bytearray = None) -> None:
+        """
+        Reset the 1-Wire bus and address a single device with Match ROM,
+        or all of them with Skip ROM if no ROM address is provided.
+
+        :param rom: The ROM address of the device (optional)
+        """
+        self.onewire_reset()
         if rom:
-            self.onewire_reset()
-            self.onewire_byte = 0x55
+            self.onewire_byte = _DS18B20_ROM
             for byte in rom:
                 self.onewire_byte = byte
         else:
-            self.onewire_reset()
             self.onewire_byte = 0xCC
-        self.onewire_byte = 0xBE
-        data = bytearray(9)
-        for i in range(9):
-            data[i] = self.onewire_byte
-        raw = (data[1] << 8) | data[0]
-        if raw & 0x8000:
-            raw -= 1 << 16
-        celsius = raw / 16.0
-        return celsius
 
     @property
     def channel(self) -> int:
@@ -403,31 +780,30 @@ class DS248x:
         if self._selected_channel is None:
             raise ValueError("No channel has been selected yet")
         channel_code = self._selected_channel + (~self._selected_channel << 4) & 0xFF
-        cmd = bytearray([_CHANNEL_SELECT, channel_code])
-        reply = bytearray(1)
-        self.i2c_device.writeto(self.address, cmd)
-        self.i2c_device.readfrom_into(self.address, reply)
-        return_codes = [0xB8, 0xB1, 0xAA, 0xA3, 0x9C, 0x95, 0x8E, 0x87]
-        if reply[0] in return_codes:
-            return return_codes.index(reply[0])
+        self._write(self._command(_CHANNEL_SELECT, channel_code))
+        self._read_ptr = _REG_CHANNEL
+        self._read_into(self._reply)
+        if self._reply[0] in _CHANNEL_CODES:
+            return _CHANNEL_CODES.index(self._reply[0])
         raise ValueError("Unknown channel code returned from the device")
 
     @channel.setter
     def channel(self, chan: int) -> None:
         """
-        Sets the channel on the DS2482-800.
+        Sets the channel on the DS2482-800, the command is sent only if
+        a different channel was selected.
 
         :param chan: Channel to use, from 0 to 7 inclusive
         """
         if chan > 7:
             raise ValueError("Channel must be between 0 and 7")
+        if chan == self._selected_channel:
+            return # already selected, nothing to send
         channel_code = chan + (~chan << 4) & 0xFF
-        cmd = bytearray([_CHANNEL_SELECT, channel_code])
-        reply = bytearray(1)
-        self.i2c_device.writeto(self.address, cmd)
-        self.i2c_device.readfrom_into(self.address, reply)
-        return_codes = [0xB8, 0xB1, 0xAA, 0xA3, 0x9C, 0x95, 0x8E, 0x87]
-        if return_codes[chan] != reply[0]:
+        self._write(self._command(_CHANNEL_SELECT, channel_code))
+        self._read_ptr = _REG_CHANNEL
+        self._read_into(self._reply)
+        if _CHANNEL_CODES[chan] != self._reply[0]:
             raise RuntimeError("Failed to set the channel")
         self._selected_channel = chan
 
@@ -1,19 +1,32 @@
 #!/usr/bin/micropython
 
 import math
-import micropython
-#import sched as micropython
+import array
+import gc
+try:
+    import micropython
+except ImportError: # CPython, emulated scheduler and time ticks
+    import sched as micropython
 import machine
 import time
-import ujson
-import network
-import ntptime
+try:
+    from time import ticks_ms, ticks_us, ticks_add, ticks_diff
+except ImportError: # CPython, time ticks from the emulation
+    from sched import ticks_ms, ticks_us, ticks_add, ticks_diff
+import errno
+try:
+    import ujson
+except ImportError: # CPython
+    import json as ujson
 import socket
 import select
+import knovahttp
 
 
-# tentative main loop, cb must return after a reasonable time
-def KnovaMain(jsonconf, cb):
+# tentative main loop, cb must return after a reasonable time; with a
+# simulator the node runs on its virtual clock for the simulated duration
+def KnovaMain(jsonconf, cb, sim=None):
+    if sim is not None: KnovaTool.setclock(sim.clock)
     confs = ujson.loads(jsonconf)
     # json configuration should be an iterable of single-tool configurations
     while(True):
@@ -22,18 +35,40 @@ def KnovaMain(jsonconf, cb):
         KnovaTool.connectall()
         actres = 0
         while (type(actres) is int):
-            if actres != 0: time.sleep(10) # wait and repeat download
+            if actres != 0: KnovaTool.clock.sleep(10) # wait and repeat download
             actres = KnovaTool.activateall()
         if type(actres) is str: # new conf obtained, download it
             confs = ujson.loads(actres)
         else:
             break
+    if sim is not None:
+        sim.run(cb)
+        return sim
     while(True):
         cb()
+        KnovaSafePoint()
         KnovaTool.lptimer.checktimer()
+        KnovaTool.runstep()
+        if KnovaTool.scheduler is not None:
+            KnovaTool.scheduler.run()
+            KnovaTool.scheduler.idle()
+
+
+# run the callbacks queued by the emulated micropython.schedule, on the
+# device they run by themselves between bytecodes
+def KnovaSafePoint():
+    if hasattr(micropython, "runpending"): micropython.runpending()
 
 
 def KnovaDispatcher(conf):
+    prof = KnovaTool.profiler
+    if prof is not None: prof.enter()
+    tool = KnovaNewTool(conf)
+    if prof is not None: prof.leave(-1 if tool is None else tool.id, 0)
+    return tool
+
+
+def KnovaNewTool(conf):
     typ = conf.get("type", "")
     if conf["type"] == "wifinetwork":
         return KnovaWiFiNetwork(conf)
@@ -43,6 +78,8 @@ def KnovaDispatcher(conf):
         return KnovaPushButton(conf)
     if conf["type"] == "onoffbutton":
         return KnovaOnOffButton(conf)
+    if conf["type"] == "inputbank":
+        return KnovaInputBank(conf)
     if conf["type"] == "analoginput":
         return KnovaAnalogInput(conf)
     if conf["type"] == "owbus":
@@ -61,52 +98,190 @@ def KnovaDispatcher(conf):
         return KnovaOnOffSwitch(conf)
     if conf["type"] == "regulator":
         return KnovaRegulator(conf);
+    if conf["type"] == "thresholdbank":
+        return KnovaThresholdBank(conf)
     if conf["type"] == "digitalout":
         return KnovaDigitalOut(conf)
+    if conf["type"] == "expression":
+        return KnovaExpression(conf)
+    if conf["type"] == "weeklyschedule":
+        return KnovaWeeklySchedule(conf)
+    if conf["type"] == "opentherm":
+        return KnovaOpenTherm(conf)
+    if conf["type"] == "latencytrace":
+        return KnovaLatencyTrace(conf)
+    if conf["type"] == "profiler":
+        return KnovaProfiler(conf)
+    if conf["type"] == "scheduler":
+        return KnovaScheduler(conf)
     print("unknown tool type: "+conf["type"])
     return None
 
 
+# time source of the timer engine and of the tools, wraps the time module
+class KnovaClock:
+    virtual = False
+
+    def time(self):
+        return time.time()
+
+    def localtime(self, secs=None):
+        return time.localtime(self.time() if secs is None else secs)
+
+    def gmtime(self, secs=None):
+        return time.gmtime(self.time() if secs is None else secs)
+
+    def ticks_ms(self):
+        return ticks_ms()
+
+    def ticks_add(self, ticks, delta):
+        return ticks_add(ticks, delta)
+
+    def ticks_diff(self, ticks1, ticks2):
+        return ticks_diff(ticks1, ticks2)
+
+    def us(self):
+        # microsecond counter for device emulation
+        return ticks_us()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+
+# virtual clock for simulation, time only moves on advance(); ticks wrap
+# as on the target; device events (emulated timers, pin changes) are
+# kept sorted and fired when the clock passes their time
+class KnovaSimClock(KnovaClock):
+    virtual = True
+    ticksperiod = 1 << 30
+
+    def __init__(self, start=0):
+        self.epoch = int(start) # time() at now = 0
+        self.now = 0 # virtual us, never wraps
+        self.events = [] # (us, seq, cb), sorted
+        self.seq = 0
+
+    def time(self):
+        return self.epoch + self.now//1000000
+
+    def ticks_ms(self):
+        return (self.now//1000) & (self.ticksperiod - 1)
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) & (self.ticksperiod - 1)
+
+    def ticks_diff(self, ticks1, ticks2):
+        half = self.ticksperiod >> 1
+        return ((ticks1 - ticks2 + half) & (self.ticksperiod - 1)) - half
+
+    def us(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.advance(int(secs*1000000))
+
+    def after(self, delta, cb):
+        # device event in delta us
+        ev = (self.now + int(delta), self.seq, cb)
+        self.seq += 1
+        n = len(self.events)
+        for i in range(len(self.events)):
+            if ev[0] < self.events[i][0]:
+                n = i
+                break
+        self.events.insert(n, ev)
+
+    def advance(self, delta):
+        # move forward by delta us, firing device events on the way
+        end = self.now + int(delta)
+        while len(self.events) > 0 and self.events[0][0] <= end:
+            ev = self.events.pop(0)
+            if ev[0] > self.now: self.now = ev[0]
+            ev[2]()
+            if len(self.events) == 0 or self.events[0][0] > self.now:
+                KnovaSafePoint() # events at the same time come as a burst
+        if end > self.now: self.now = end
+
+    def untiltime(self, t):
+        # us until time() becomes greater than t
+        return max((math.floor(t - self.epoch) + 1)*1000000 - self.now, 0)
+
+    def untilticks(self, deadline):
+        # us until ticks_ms() reaches deadline
+        delta = self.ticks_diff(deadline, self.ticks_ms())
+        if delta <= 0: return 0
+        return delta*1000 - self.now%1000
+
+
 class KnovaLPTimer:
     rtlist = []
     ptlist = []
+    mslist = []
     prec = 1
     timerid: int = 0
     nonetimer: int = -1
 
-    def __init__(self):
+    def __init__(self, clock=None):
         self.rtlist = []
         self.ptlist = []
+        self.mslist = [] # short one-shot timers, ticks_ms resolution
         self.prec = 1
         self.timerid: int = 0
+        self.fired = 0 # callbacks called
+        self.clock = KnovaClock() if clock is None else clock
+        self.dispatch = None # KnovaScheduler.post, callbacks are called if None
     
-    def addtimer(self, delta, cb=None, period=0, id=None):
+    def newid(self):
+        ret = self.timerid
+        self.timerid += 1
+        if self.timerid == self.nonetimer: self.timerid += 1
+        return ret
+
+    def addtimer(self, delta, cb=None, period=0, id=None, prio=1):
         if cb is None: return self.nonetimer
-        abstime = time.time() + delta # or we receive abs time?
-        n = 0
-        for n in range(len(self.rtlist)):
-            if abstime < self.rtlist[n][0]: break
+        abstime = self.clock.time() + delta # or we receive abs time?
+        n = len(self.rtlist) # after all the earlier ones
+        for i in range(len(self.rtlist)):
+            if abstime < self.rtlist[i][0]:
+                n = i
+                break
         if id is None:
-            self.rtlist.insert(n, (abstime, cb, period, self.timerid))
-            ret = self.timerid
-            self.timerid += 1
-            if self.timerid == self.nonetimer: self.timerid += 1
+            ret = self.newid()
+            self.rtlist.insert(n, (abstime, cb, period, ret, prio))
         else: # conserve timerid for periodic timers, trust the caller
-            self.rtlist.insert(n, (abstime, cb, period, id))
+            self.rtlist.insert(n, (abstime, cb, period, id, prio))
             ret = id
         return ret
 
+    def addtimerms(self, delta, cb=None, prio=1):
+        # one-shot timer with delta in ms, for waits shorter than prec
+        if cb is None: return self.nonetimer
+        clock = self.clock
+        deadline = clock.ticks_add(clock.ticks_ms(), int(delta))
+        n = len(self.mslist)
+        for i in range(len(self.mslist)):
+            if clock.ticks_diff(deadline, self.mslist[i][0]) < 0:
+                n = i
+                break
+        ret = self.newid()
+        self.mslist.insert(n, (deadline, cb, 0, ret, prio))
+        return ret
+
 #    def addperiodictimer(self, period, cb):
 #        self.ptlist.append((0, cb, period)) # useful?
 #        self.addtimer(period, cb, period)
 
     def checktimer(self):
-        now = time.time()
+        clock = self.clock
+        while len(self.mslist) > 0 and \
+              clock.ticks_diff(self.mslist[0][0], clock.ticks_ms()) <= 0:
+            self.fire(self.mslist.pop(0))
+        now = clock.time()
         while(True):
             if len(self.rtlist) <= 0: return
             if self.rtlist[0][0] - now < self.prec:
                 self.consumetimer()
-                now = time.time() # time may have passed in callback
+                now = clock.time() # time may have passed in callback
             else:
                 return
 
@@ -114,29 +289,294 @@ class KnovaLPTimer:
         rt = self.rtlist[0]
         del self.rtlist[0] # rt is not deleted here (empirically)
         # if periodic, schedule next event
-        if rt[2] > 0: self.addtimer(rt[2], rt[1], rt[2])
-        rt[1]() # call after-timer callback
+        if rt[2] > 0: self.addtimer(rt[2], rt[1], rt[2], rt[3], rt[4])
+        self.fire(rt) # call after-timer callback
+
+    def fire(self, rt):
+        self.fired += 1
+        if self.dispatch is None:
+            rt[1]()
+        else: # run by the scheduler in the class of the timer
+            self.dispatch(rt[4], rt[1])
 
     def canceltimer(self, timerid):
         if timerid == self.nonetimer: return
-        for n in range(len(self.rtlist)):
-            if self.rtlist[n][3] == timerid:
-                del self.rtlist[n]
-                return
+        for tlist in (self.rtlist, self.mslist):
+            for n in range(len(tlist)):
+                if tlist[n][3] == timerid:
+                    del tlist[n]
+                    return
 
 class KnovaTimerInstance:
-    def __init__(self, engine, delta, cb=None, period=0):
+    def __init__(self, engine, delta, cb=None, period=0, prio=1):
         self.engine = engine
-        self.id = engine.addtimer(delta, cb, period)
+        self.id = engine.addtimer(delta, cb, period, prio=prio)
 
     def cancel(self):
         self.engine.canceltimer(self.id)
 
+
+# discrete-event simulator: runs the main loop on a virtual clock jumping
+# straight to the next timer or device event, and measures the real time
+# spent in timer callbacks and propagation
+class KnovaSimulator:
+    def __init__(self, duration, start=0):
+        self.duration = duration # virtual seconds to run
+        self.clock = KnovaSimClock(start)
+        self.loops = 0
+        self.cpuus = 0 # real us spent in the main loop
+
+    def nextevent(self):
+        # us until the first timer or device event, None if nothing is due
+        clock = self.clock
+        lpt = KnovaTool.lptimer
+        delta = None
+        sch = KnovaTool.scheduler
+        if len(KnovaTool.steplist) > 0 or (sch is not None and sch.pending()):
+            return 0 # steps left to run now
+        if len(lpt.mslist) > 0:
+            delta = clock.untilticks(lpt.mslist[0][0])
+        if len(lpt.rtlist) > 0:
+            d = clock.untiltime(lpt.rtlist[0][0] - lpt.prec)
+            if delta is None or d < delta: delta = d
+        if len(clock.events) > 0:
+            d = max(clock.events[0][0] - clock.now, 0)
+            if delta is None or d < delta: delta = d
+        return delta
+
+    def run(self, cb=None):
+        clock = self.clock
+        end = clock.now + int(self.duration*1000000)
+        while True:
+            start = ticks_us()
+            if cb is not None: cb()
+            clock.advance(0) # device events due now
+            KnovaSafePoint()
+            KnovaTool.lptimer.checktimer()
+            KnovaTool.runstep()
+            if KnovaTool.scheduler is not None: KnovaTool.scheduler.run()
+            self.cpuus += ticks_diff(ticks_us(), start)
+            self.loops += 1
+            delta = self.nextevent()
+            if delta is None or clock.now + delta > end:
+                clock.advance(end - clock.now)
+                return
+            clock.advance(delta)
+
+    def stats(self):
+        return {"virtual": self.clock.now/1000000, "loops": self.loops,
+                "fired": KnovaTool.lptimer.fired, "cpuus": self.cpuus}
+
+
+# read-through cache of a physical measurement: values younger than ttl ms
+# are reused, up to ttl+stale ms they are still returned while a new read
+# is scheduled on the timer engine, older values are read synchronously
+class KnovaCachedRead:
+    def __init__(self, engine, readcb, ttl, stale=0):
+        self.engine = engine
+        self.readcb = readcb
+        self.ttl = ttl
+        self.stale = stale
+        self.val = None
+        self.stamp = None # ticks_ms of last read attempt
+        self.good = 0 # ticks_ms of last successful read
+        self.time = 0 # time.time() of last successful read
+        self.seq = 0 # number of successful physical reads
+        self.hits = 0
+        self.errors = 0
+        self.failed = False # last read attempt failed
+        self.pending = False
+
+    def get(self):
+        # None until a read succeeds
+        if self.stamp is not None:
+            clock = self.engine.clock
+            age = clock.ticks_diff(clock.ticks_ms(), self.stamp)
+            if age < self.ttl:
+                self.hits += 1
+                return self.val
+            if self.val is not None and age < self.ttl + self.stale:
+                if not self.pending: # revalidate outside of caller
+                    self.pending = True
+                    self.engine.addtimer(0, self.revalidate, prio=3)
+                self.hits += 1
+                return self.val
+        return self.read()
+
+    def read(self):
+        # a failed read (sensor timeout, checksum) keeps the last value,
+        # retried after ttl
+        clock = self.engine.clock
+        self.stamp = clock.ticks_ms()
+        self.pending = False
+        try:
+            val = self.readcb()
+        except OSError:
+            self.errors += 1
+            self.failed = True
+            return self.val
+        self.failed = False
+        self.val = val
+        self.good = self.stamp
+        self.time = clock.time()
+        self.seq += 1
+        return self.val
+
+    def age(self):
+        # ms since the last successful read, None before it
+        if self.seq == 0: return None
+        clock = self.engine.clock
+        return clock.ticks_diff(clock.ticks_ms(), self.good)
+
+    def revalidate(self):
+        if self.pending: self.read()
+
+
+# fixed size circular buffer of timestamped records of nfield floats each,
+# memory is allocated once at creation
+class KnovaRing:
+    def __init__(self, size, nfield):
+        self.size = size
+        self.nfield = nfield
+        self.t = array.array("L", (0 for _ in range(size)))
+        self.v = array.array("f", (0. for _ in range(size*nfield)))
+        self.head = 0 # next slot to be written
+        self.count = 0
+
+    def append(self, t):
+        # take next slot for time t, return offset of its fields in self.v
+        i = self.head
+        self.t[i] = t
+        self.head = (i + 1) % self.size
+        if self.count < self.size: self.count += 1
+        return i*self.nfield
+
+    def indices(self):
+        # slot indices from oldest to newest, without building a list
+        i = (self.head - self.count) % self.size
+        for _ in range(self.count):
+            yield i
+            i = (i + 1) % self.size
+
+
+# one downsampling level of a history, accumulates min/sum/max of the
+# current time bucket and flushes min/avg/max to its ring when the bucket ends
+class KnovaHistoryLevel:
+    def __init__(self, period, size, nvar):
+        self.period = period
+        self.nvar = nvar
+        self.ring = KnovaRing(size, 3*nvar)
+        self.acc = array.array("f", (0. for _ in range(3*nvar))) # min, sum, max
+        self.bucket = -1
+        self.count = 0
+
+    def add(self, t, vals):
+        b = t // self.period
+        if b != self.bucket:
+            self.flush()
+            self.bucket = b
+        acc = self.acc
+        nvar = self.nvar
+        for j in range(nvar):
+            v = vals[j]
+            if self.count == 0:
+                acc[j] = v
+                acc[nvar+j] = v
+                acc[2*nvar+j] = v
+            else:
+                if v < acc[j]: acc[j] = v
+                acc[nvar+j] += v
+                if v > acc[2*nvar+j]: acc[2*nvar+j] = v
+        self.count += 1
+
+    def flush(self):
+        if self.count == 0: return
+        off = self.ring.append(self.bucket*self.period)
+        self.fields(self.ring.v, off)
+        self.count = 0
+
+    def fields(self, dest, off):
+        # write min, avg, max of each variable of current bucket at dest[off]
+        nvar = self.nvar
+        for j in range(nvar):
+            dest[off+3*j] = self.acc[j]
+            dest[off+3*j+1] = self.acc[nvar+j]/self.count
+            dest[off+3*j+2] = self.acc[2*nvar+j]
+
+
+# sensor history: raw ring buffer plus 10-minute and hourly min/avg/max
+# levels, all updated incrementally at every new measurement
+class KnovaHistory:
+    levels = (("raw", 0), ("10m", 600), ("1h", 3600))
+
+    def __init__(self, nvar, sizes):
+        self.nvar = nvar
+        self.res = {}
+        for lev, size in zip(KnovaHistory.levels, sizes):
+            if size <= 0: continue
+            if lev[1] == 0:
+                self.res[lev[0]] = KnovaRing(size, nvar)
+            else:
+                self.res[lev[0]] = KnovaHistoryLevel(lev[1], size, nvar)
+
+    def fromconf(conf, nvar):
+        # class method, return None if history is not configured
+        nraw = conf.get("history", 0)
+        if nraw <= 0: return None
+        return KnovaHistory(nvar, (nraw, conf.get("history10m", 144),
+                                   conf.get("history1h", 168)))
+
+    def add(self, t, vals):
+        for r in self.res.values():
+            if isinstance(r, KnovaRing):
+                off = r.append(t)
+                for j in range(self.nvar):
+                    r.v[off+j] = vals[j]
+            else:
+                r.add(t, vals)
+
+    def send(self, req, res):
+        # stream the requested resolution as json, one record at a time
+        r = self.res.get(res, None)
+        if r is None:
+            req.senderror(404)
+            return
+        if isinstance(r, KnovaRing):
+            ring = r
+            period = 0
+        else:
+            ring = r.ring
+            period = r.period
+        if not req.sendheader("application/json"): return
+        req.sendpart('{"res":"%s","period":%d,"data":[' % (res, period))
+        sep = ""
+        nfield = ring.nfield
+        for i in ring.indices():
+            if not req.sendpart(sep + self.record(ring.t[i], ring.v, i*nfield, nfield)):
+                return
+            sep = ","
+        if period > 0 and r.count > 0: # partial current bucket
+            cur = array.array("f", (0. for _ in range(nfield)))
+            r.fields(cur, 0)
+            req.sendpart(sep + self.record(r.bucket*period, cur, 0, nfield))
+        req.sendpart("]}")
+        req.sendend()
+
+    def record(self, t, v, off, nfield):
+        return "[%d,%s]" % (t, ",".join([str(v[off+j]) for j in range(nfield)]))
+
 # generic tool
 class KnovaTool:
+    prio = 3 # KnovaScheduler class: 0 input, 1 actuator, 2 web, 3 sensor
     unitlist = {}
     timercount = 1 # reserve timer n.0 for main loop
-    lptimer = KnovaLPTimer()
+    clock = KnovaClock()
+    lptimer = KnovaLPTimer(clock)
+    trace = None # KnovaLatencyTrace if configured
+    profiler = None # KnovaProfiler if configured
+    scheduler = None # KnovaScheduler if configured
+    http = knovahttp.HttpClient() # outbound connections of all tools
+    steplist = [] # step generators run by the main loop without scheduler
 
     def __init__(self, conf):
         self.name = conf["name"]
@@ -168,7 +608,8 @@ class KnovaTool:
             self.timer = KnovaTimerInstance(KnovaTool.lptimer,
                                             self.updateperiod,
                                             self.periodicupdate,
-                                            self.updateperiod)
+                                            self.updateperiod,
+                                            self.prio)
 
     def activateall():
         # class method for activating all configured instances
@@ -196,15 +637,46 @@ class KnovaTool:
             i = i + 1
         if 'lastevent' in self.__dict__:
             state["time"] = self.lastevent
+        if 'cache' in self.__dict__: # age in ms of the value served
+            state["age"] = self.cache.age()
         req.sendresponse("application/json", ujson.dumps(state))
 
 
+    def runsteps(steps, prio):
+        # class method for running a generator of short work steps in
+        # the background, with the scheduler if configured and accepting
+        # them, a step per main loop pass otherwise (see runstep)
+        if KnovaTool.scheduler is None or \
+           not KnovaTool.scheduler.poststeps(prio, steps):
+            KnovaTool.steplist.append(steps)
+
+    def runstep():
+        # class method for the main loop, a step of every generator
+        # queued by runsteps
+        steplist = KnovaTool.steplist
+        i = 0
+        while i < len(steplist):
+            try:
+                next(steplist[i])
+                i += 1
+            except StopIteration:
+                del steplist[i]
+
+
+    def setclock(clock):
+        # class method for replacing the time source, before creating tools
+        KnovaTool.clock = clock
+        KnovaTool.lptimer.clock = clock
+        if hasattr(machine, "setclock"): # unix port shim
+            machine.setclock(clock)
+
+
     def gettimer():
         # class method for getting an available global timer
         if KnovaTool.timercount > 3:
-            raise
+            raise RuntimeError("no hardware timer left, 3 are available")
         t = machine.Timer(KnovaTool.timercount)
-        KnovaTool.timercount += 1 # check not to exceed (max 3)
+        KnovaTool.timercount += 1
         return t
 
 
@@ -223,6 +695,8 @@ class KnovaWiFiNetwork(KnovaTool):
         self.ntphost = conf.get("ntphost", None)
         self.ntpready = False
         self.getconf = conf.get("getconf", None)
+        if self.getconf is not None: # http or https, anything else fails here
+            knovahttp.spliturl(self.getconf)
         self.nic = network.WLAN(network.STA_IF)
         self.nic.active(True)
         if self.ntp:
@@ -242,6 +716,7 @@ class KnovaWiFiNetwork(KnovaTool):
                 time.sleep(1)
             # if self.blocking should repeat indefinitely ntp and getconf
             if self.ntp and not self.ntpready:
+                import ntptime
                 try:
                     ntptime.settime()
                     self.ntpready = True
@@ -249,23 +724,25 @@ class KnovaWiFiNetwork(KnovaTool):
                     pass
             if self.getconf is not None:
                 import binascii
-                self.getconf.replace("%M", str(binascii.hexlify(self.nic.config('mac'), ':')))
+                self.getconf = self.getconf.replace("%M", binascii.hexlify(self.nic.config('mac'), ':').decode())
 #                self.getconf.replace("%I", self.nic.ipconfig()[0]) # ipconfig not defined?
                 # sta_if.config('mac') => b'$\n\xc4\x00\x01\x10' array len=6
                 # sta_if.ifconfig()[0] => '0.0.0.0'
+                # download conf by http and return it
+                body = bytearray()
                 try:
-                    r = request("GET", self.getconf, timeout=10000)
-                    newconf = r.text
-                    r.close()
-                    # download conf by http and return it
+                    r = KnovaTool.http.get(self.getconf, sink=body.extend, timeout=10000)
+                    if r.status != 200: raise ValueError("status %d" % r.status)
+                    newconf = str(body, "utf-8")
                     self.getconf = None
-                except:
+                except (OSError, ValueError):
                     newconf = 1 # check in KnovaMain, was previously None
                 return newconf
 
 
     def periodicupdate(self): # can i do something to stimulate connection?
         if self.nic.isconnected() and self.ntp:
+            import ntptime
             ntptime.settime()
 
 
@@ -306,6 +783,31 @@ class KnovaWebRequest:
             pass
 
 
+    # streamed response in parts, sendheader and sendpart return False
+    # when the client went away
+    def sendheader(self, ctype):
+        try:
+            self.fp.send(b'HTTP/1.0 200 OK\r\nContent-type: '+ctype+'\r\nConnection: close\r\n\r\n')
+        except:
+            return False
+        return True
+
+
+    def sendpart(self, cbody):
+        try:
+            self.fp.send(bytes(cbody, "ascii"))
+        except:
+            return False
+        return True
+
+
+    def sendend(self):
+        try:
+            self.fp.close()
+        except:
+            pass
+
+
     def sendemptyresponse(self): # correct?
         try:
             self.fp.send(b'HTTP/1.0 200 OK\r\nConnection: close\r\n\r\n')
@@ -315,6 +817,8 @@ class KnovaWebRequest:
 
 
 class KNovaWebServer(KnovaTool):
+    prio = 2 # web
+
     def __init__(self, conf):
         conf["name"] = "web" # reset name for identification by other tools, unique tool, improve
         super().__init__(conf)
@@ -338,6 +842,8 @@ class KNovaWebServer(KnovaTool):
             self.register(("machine","reset"), self.resetweb)
 
     def register(self, req, callback):
+        if KnovaTool.profiler is not None: # account the handler to its tool
+            callback = KnovaTool.profiler.wrapweb(req[0], callback)
         self.webhooks.append((req, callback))
 
     def resetweb(self, req):
@@ -443,6 +949,10 @@ class KNovaWebServer(KnovaTool):
         request.senderror(404)
 
 
+    def wait(self, ms):
+        # wait up to ms for a request, True if one is ready
+        return len(self.httpoll.poll(ms)) > 0
+
     def periodicupdate(self): # improve
         ready = self.httpoll.poll(1000)
         # handle errors in select here
@@ -467,12 +977,13 @@ class KnovaMultiTool(KnovaTool):
         self.filterms = conf.get("filterms", 400) # >0 to enable debounce filter
         if self.filterms > 0:
             self.filters = math.ceil(self.filterms/1000) # for wrap check
-            self.lastevent = time.ticks_ms()
-            self.lasteventnw = time.time()
+            self.lastevent = KnovaTool.clock.ticks_ms()
+            self.lasteventnw = KnovaTool.clock.time()
+        self.history = None # set by sensors supporting history
         self.filterreps = conf.get("filterreps", 300) # >0 to enable anti-repetiotion filter
         # possible bug here, i reset lastevent with a different time unit
         if self.filterreps > 0:
-            self.lastevent = time.time()
+            self.lastevent = KnovaTool.clock.time()
 
 
     def connect(self):
@@ -494,25 +1005,40 @@ class KnovaMultiTool(KnovaTool):
         return
 
 
+    def registerhistory(self):
+        if self.web and self.history is not None:
+            KnovaTool.unitlist["web"].register((self.name,"history"), self.gethistory)
+
+    def addhistory(self):
+        if self.history is not None:
+            self.history.add(self.lastevent, self.state)
+
+    def gethistory(self, req):
+        self.history.send(req, req.querydict.get("res", "raw"))
+
+
     def noisefilter(self):
         if self.filterms > 0:
-            now = time.ticks_ms()
-            nownw = time.time() # wrap check
-            if time.ticks_diff(now, self.lastevent) < self.filterms and \
+            clock = KnovaTool.clock
+            now = clock.ticks_ms()
+            nownw = clock.time() # wrap check
+            if clock.ticks_diff(now, self.lastevent) < self.filterms and \
                nownw - self.lasteventnw < self.filters: return True # too early, do nothing
             self.lastevent = now
             self.lasteventnw = nownw
         return False
 
     def repetitionfilter(self):
-        if self.filtersrep > 0:
-            now = time.time()
-            if now - self.lastevent < self.filtersrep: return True # too early, do nothing
+        if self.filterreps > 0:
+            now = KnovaTool.clock.time()
+            if now - self.lastevent < self.filterreps: return True # too early, do nothing
             self.lastevent = now
         return False
 
 
 class KnovaPushButton(KnovaMultiTool):
+    prio = 0 # input
+
     def __init__(self, conf):
         super().__init__(conf)
         self.pushtype = conf.get("pushtype", "push") # push or release
@@ -544,13 +1070,22 @@ class KnovaPushButton(KnovaMultiTool):
 
 
     def propagate(self, origin):
+        tr = KnovaTool.trace
+        if tr is not None: tr.begin(self)
         super().propagate(origin)
+        if tr is not None: tr.end(self)
 
     def push(self, pin):
+        tr = KnovaTool.trace
+        if tr is not None: t0 = ticks_us()
         if self.state[1] == 1:
             self.state[0] = 1 # will never change after first pushrelease?!
             if self.noisefilter(): return
-            micropython.schedule(self.propagate, None)
+            if tr is not None: tr.irq(self, t0)
+            try:
+                micropython.schedule(self.propagate, None)
+            except RuntimeError: # schedule queue full, the push is lost
+                pass
 
 
     def pushweb(self, req):
@@ -568,6 +1103,8 @@ class KnovaPushButton(KnovaMultiTool):
 
 
 class KnovaOnOffButton(KnovaMultiTool):
+    prio = 0 # input
+
     def __init__(self, conf):
         super().__init__(conf)
         self.invert = conf.get("invert", False)
@@ -591,142 +1128,677 @@ class KnovaOnOffButton(KnovaMultiTool):
     def propagate(self, origin):
         # here it may be too early to trust pin value
         # schedule a state refresh after self.filterms???
+        tr = KnovaTool.trace
+        if tr is not None: tr.begin(self)
         self.state[0] = self.pin.value() != self.invert
         super().propagate(origin)
+        if tr is not None: tr.end(self)
 
     def periodicupdate(self):
         self.propagate(None)
 
     def onoff(self, pin):
+        tr = KnovaTool.trace
+        if tr is not None: t0 = ticks_us()
         if self.noisefilter(): return
-        micropython.schedule(self.propagate, None)
+        if tr is not None: tr.irq(self, t0)
+        try:
+            micropython.schedule(self.propagate, None)
+        except RuntimeError: # schedule queue full, periodicupdate recovers
+            pass
+
+
+class KnovaInputLine(KnovaMultiTool):
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.state = bytearray(1)
+
+
+# many digital inputs sampled together on a fast timer instead of an irq
+# per pin, each bit is debounced by a 2 bit vertical counter (4 equal
+# samples in a row) so that the cost per tick is fixed however much the
+# contacts bounce; every input is the pseudo-tool "<bank>.<n>" behaving
+# as a pushbutton ("push", "release") or an onoffbutton ("onoff")
+class KnovaInputBank(KnovaMultiTool):
+    prio = 0 # input
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        n = len(conf["pins"])
+        self.pins = tuple([machine.Pin(p, mode=machine.Pin.IN, pull=machine.Pin.PULL_UP)
+                           for p in conf["pins"]])
+        self.scanms = conf.get("scanms", 5) # debounce time is 4*scanms
+        invert = conf.get("invert", False)
+        if not isinstance(invert, list): invert = [invert]*n
+        modes = conf.get("mode", "onoff")
+        if not isinstance(modes, list): modes = [modes]*n
+        self.invmask = 0
+        self.pushmask = 0 # lines propagating on the rising edge
+        self.releasemask = 0 # lines propagating on the falling edge
+        for i in range(n):
+            if invert[i]: self.invmask |= 1 << i
+            if modes[i] != "release": self.pushmask |= 1 << i
+            if modes[i] != "push": self.releasemask |= 1 << i
+        self.mask = (1 << n) - 1
+        self.debounced = 0 # debounced levels, a bit per line
+        self.ct0 = self.mask # vertical counter bits
+        self.ct1 = self.mask
+        self.events = 0 # lines changed, not yet propagated
+        self.scheduled = False
+        self.state = bytearray(n) # debounced level of each line
+        self.lines = []
+        for i in range(n):
+            self.lines.append(KnovaInputLine(
+                {"name":"%s.%d" % (self.name, i), "type":"inputline",
+                 "filterms":0, "filterreps":0}))
+        self.scantimer = None
+
+
+    def connect(self):
+        super().connect() # call base connect method
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+
+
+    def activate(self):
+        super().activate()
+        self.debounced = self.read() # start from the current levels
+        for i in range(len(self.pins)):
+            self.state[i] = (self.debounced >> i) & 1
+            self.lines[i].state[0] = self.state[i]
+        self.scantimer = KnovaTool.gettimer()
+        self.scantimer.init(mode=machine.Timer.PERIODIC, period=self.scanms,
+                            callback=self.scan)
+
+
+    def read(self):
+        raw = 0
+        for i in range(len(self.pins)):
+            raw |= self.pins[i].value() << i
+        return raw ^ self.invmask
+
+
+    def scan(self, timer):
+        # timer callback, small integers only, nothing allocated
+        delta = self.read() ^ self.debounced
+        self.ct0 = ~(self.ct0 & delta) & self.mask
+        self.ct1 = self.ct0 ^ (self.ct1 & delta)
+        delta &= self.ct0 & self.ct1 # lines stable for 4 samples
+        self.debounced ^= delta
+        self.events |= delta
+        if self.events and not self.scheduled:
+            try:
+                micropython.schedule(self.flush, 0)
+                self.scheduled = True
+            except RuntimeError: # schedule queue full, retry next tick
+                pass
+
+
+    def flush(self, arg):
+        self.scheduled = False
+        events = self.events
+        self.events = 0
+        level = self.debounced
+        for i in range(len(self.pins)):
+            bit = 1 << i
+            if not events & bit: continue
+            self.state[i] = 1 if level & bit else 0
+            line = self.lines[i]
+            line.state[0] = self.state[i]
+            if bit & (self.pushmask if level & bit else self.releasemask):
+                line.propagate(self)
+        super().propagate(None) # tools connected to the whole bank
 
 
 class KnovaAnalogInput(KnovaMultiTool):
+    # a single hardware timer samples all the analog inputs, ticking at
+    # the gcd of their sample periods; the first input activated takes it
+    # with KnovaTool.gettimer, one of the few of the ESP32, even if it is
+    # the only analog input (the lptimer is too coarse for sampling)
+    adctimer = None # not self.timer, the periodic update timer of a tool
+    tickms = 0
+    active = [] # inputs filling a window
+
     def __init__(self, conf):
         super().__init__(conf)
-        from machine import ADC
         self.pin = machine.Pin(conf["pin"], mode=machine.Pin.IN)
         self.scale = conf.get("scale", 1.0)
         self.offset = conf.get("offset", 0.0)
-        self.nsamples = conf.get(nsamples, 10)
-        self.scale = self.scale/self.nsamples # avoid division later
+        self.nsamples = conf.get("nsamples", 10)
+        self.sampleperiod = conf.get("sampleperiod", 10) # ms between samples
+        self.filter = conf.get("filter", "mean") # mean, median or trimmed
+        # samples discarded at each end for trimmed mean
+        self.trim = min(int(self.nsamples*conf.get("trim", 0.2)),
+                        (self.nsamples - 1)//2)
         self.initdelay = conf.get("initdelay", 0)
-        self.updateperiod = conf.get("updateperiod", 60)
+        self.updateperiod = conf.get("updateperiod", 60) # 0 for continuous
         self.state = array.array("f",(0.0,))
+        self.history = KnovaHistory.fromconf(conf, len(self.state))
+        # double buffer, the timer fills one while the other is filtered
+        self.samples = (array.array("H", (0 for _ in range(self.nsamples))),
+                        array.array("H", (0 for _ in range(self.nsamples))))
+        self.sorted = array.array("H", (0 for _ in range(self.nsamples)))
+        self.buf = 0 # buffer being filled
+        self.nsample = 0 # next sample in buffer
+        self.acquiring = False
+        self.ticks = 0 # timer ticks since the last sample
 
     def activate(self):
-        self.adc = ADC(self.pin, attn=ADC.ATTN_11DB) # ESP32 specific
+        self.adc = machine.ADC(self.pin, attn=machine.ADC.ATTN_11DB) # ESP32 specific
+        cls = KnovaAnalogInput
+        if cls.adctimer is None:
+            cls.adctimer = KnovaTool.gettimer()
+        a, b = cls.tickms, self.sampleperiod
+        while b: a, b = b, a % b
+        if a != cls.tickms:
+            cls.tickms = a
+            if len(cls.active) > 0: cls.starttimer()
         super().activate() # schedule timer
+        if self.updateperiod == 0:
+            self.startacq()
 
     def connect(self):
         super().connect() # call base connect method
         if self.web: # connect to web server
             KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+        self.registerhistory()
+
+    def startacq(self):
+        # start a window of samples in background, never wait here
+        if self.acquiring: return
+        self.acquiring = True
+        self.nsample = 0
+        self.ticks = 0
+        KnovaAnalogInput.active.append(self)
+        if len(KnovaAnalogInput.active) == 1:
+            KnovaAnalogInput.starttimer()
+
+    def starttimer():
+        # class method
+        KnovaAnalogInput.adctimer.init(mode=machine.Timer.PERIODIC,
+                                       period=KnovaAnalogInput.tickms,
+                                       callback=KnovaAnalogInput.tick)
+
+    def tick(timer):
+        # class method, timer callback, samples the inputs that are due
+        active = KnovaAnalogInput.active
+        for i in range(len(active) - 1, -1, -1): # they may leave the list
+            active[i].sample()
+        if len(active) == 0: timer.deinit()
+
+    def sample(self):
+        # store a sample and hand over a completed window
+        self.ticks += 1
+        if self.ticks*KnovaAnalogInput.tickms < self.sampleperiod: return
+        self.ticks = 0
+        self.samples[self.buf][self.nsample] = self.adc.read_u16()
+        self.nsample += 1
+        if self.nsample < self.nsamples: return
+        self.nsample = 0
+        if self.updateperiod > 0: # single window per period
+            KnovaAnalogInput.active.remove(self)
+            self.acquiring = False
+        self.buf = 1 - self.buf
+        try:
+            micropython.schedule(self.windowdone, 1 - self.buf)
+        except RuntimeError: # schedule queue full, drop the window
+            pass
 
-    def propagate(self, origin):
-        state = 0.0
-        for i in range(self.nsamples):
-            state = state + self.adc.read_u16()
-            time.sleep_ms(10)
-        self.state[0] = state*self.scale + self.offset
-        self.lastevent = time.time()
-        super().propagate(origin)
+    def windowdone(self, buf):
+        self.state[0] = self.filtered(self.samples[buf])*self.scale + self.offset
+        self.lastevent = KnovaTool.clock.time()
+        self.addhistory()
+        self.propagate(None)
+
+    def filtered(self, buf):
+        n = self.nsamples
+        lo, hi = 0, n
+        if self.filter != "mean":
+            s = self.sorted
+            for i in range(n): # insertion sort, no allocation
+                v = buf[i]
+                j = i - 1
+                while j >= 0 and s[j] > v:
+                    s[j+1] = s[j]
+                    j -= 1
+                s[j+1] = v
+            buf = s
+            if self.filter == "median":
+                if n & 1: return buf[n >> 1]
+                return (buf[(n >> 1) - 1] + buf[n >> 1])/2
+            lo, hi = self.trim, n - self.trim
+        acc = 0
+        for i in range(lo, hi):
+            acc += buf[i]
+        return acc/(hi - lo)
 
     def periodicupdate(self):
-        self.propagate(None)
+        self.startacq()
 
 
-class KnovaOwBus(KnovaMultiTool):
+# common base for 1-Wire buses, keeps the inventory of device roms, per
+# channel where applicable, persisted on flash together with a bus
+# fingerprint so that at boot the cached roms are only verified instead
+# of running a full search; missing devices trigger a search in
+# background, one rom per step
+class KnovaOwBusBase(KnovaMultiTool):
     def __init__(self, conf):
         super().__init__(conf)
-        import onewire, ds18x20
+        self.romfile = conf.get("romfile", "owroms_%s.json" % self.name)
+        self.rediscoverms = conf.get("rediscoverms", 100) # ms between steps
+        self.channels = None # single channel bus
+        self.converting = False
+        self.roms = []
+        self.chanroms = [] # (channel, roms) to select every channel once
+        self.romchan = {} # rom -> channel
+        self.rediscovering = False
+
+    def fingerprint(self):
+        # identification of the physical bus, override
+        return self.typ
+
+    def setchannel(self, chan):
+        # select a channel before bus operations, override if applicable
+        return
+
+    def verifyrom(self, rom):
+        # quick presence check of a single device, override
+        return False
+
+    def searchreset(self):
+        # start a new incremental search on the current channel, override
+        return
+
+    def searchstep(self):
+        # find next rom on the current channel, None when done, override
+        return None
+
+    def setinventory(self, found):
+        # found is a list of (rom, channel)
+        self.roms = []
+        self.romchan = {}
+        self.chanroms = []
+        for chan in (self.channels or [None]):
+            roms = [rom for rom, c in found if c == chan]
+            for rom in roms:
+                self.romchan[bytes(rom)] = chan
+            self.roms.extend(roms)
+            self.chanroms.append((chan, roms))
+
+    def loadroms(self):
+        import binascii
+        try:
+            with open(self.romfile) as f:
+                inv = ujson.load(f)
+            if inv["fingerprint"] != self.fingerprint(): return None
+            return [(bytearray(binascii.unhexlify(r)), c) for r, c in inv["roms"]]
+        except:
+            return None
+
+    def saveroms(self):
+        import binascii
+        inv = {"fingerprint": self.fingerprint(),
+               "roms": [(binascii.hexlify(rom).decode(), self.romchan[bytes(rom)])
+                        for rom in self.roms]}
+        try:
+            with open(self.romfile, "w") as f:
+                ujson.dump(inv, f)
+        except:
+            print("Cannot save one wire inventory", self.romfile)
+
+    def search(self):
+        # full blocking search of all channels
+        found = []
+        for chan in (self.channels or [None]):
+            self.setchannel(chan)
+            self.searchreset()
+            while True:
+                rom = self.searchstep()
+                if rom is None: break
+                found.append((rom, chan))
+        return found
+
+    def discover(self):
+        # at activation, verify cached roms or search if there is no cache
+        cached = self.loadroms()
+        if cached is None:
+            self.setinventory(self.search())
+            self.saveroms()
+            return
+        found = []
+        for rom, chan in cached:
+            self.setchannel(chan)
+            if self.verifyrom(rom):
+                found.append((rom, chan))
+        self.setinventory(found)
+        expected = True
+        for out in self.outs: # configured thermometers must be present
+            if isinstance(out, KnovaOwThermometer) and \
+               bytes(out.romid) not in self.romchan:
+                expected = False
+        if len(found) < len(cached) or not expected:
+            self.romlost(None)
+
+    def romlost(self, rom):
+        # a device is missing, search again in background
+        if self.rediscovering: return
+        self.rediscovering = True
+        self.found = []
+        self.searchchan = 0
+        self.setchannel((self.channels or [None])[0])
+        self.searchreset()
+        KnovaTool.lptimer.addtimerms(self.rediscoverms, self.rediscoverstep, self.prio)
+
+    def rediscoverstep(self):
+        if self.converting: # do not disturb a conversion
+            KnovaTool.lptimer.addtimerms(self.rediscoverms, self.rediscoverstep, self.prio)
+            return
+        chans = self.channels or [None]
+        chan = chans[self.searchchan]
+        self.setchannel(chan)
+        rom = self.searchstep()
+        if rom is not None:
+            self.found.append((rom, chan))
+        else:
+            self.searchchan += 1
+            if self.searchchan >= len(chans): # done
+                self.setinventory(self.found)
+                self.saveroms()
+                self.found = None
+                self.rediscovering = False
+                print("One wire devices rediscovered", self.roms)
+                return
+            self.setchannel(chans[self.searchchan])
+            self.searchreset()
+        KnovaTool.lptimer.addtimerms(self.rediscoverms, self.rediscoverstep, self.prio)
+
+
+class KnovaOwBus(KnovaOwBusBase):
+    def __init__(self, conf):
+        super().__init__(conf)
+        import onewire
         self.pin = machine.Pin(conf["pin"], mode=machine.Pin.IN, pull=machine.Pin.PULL_UP) #...
+        self.pinid = conf["pin"]
         self.initdelay = conf.get("initdelay", 0)
         self.updateperiod = conf.get("updateperiod", 60)
+        # DS18B20 resolution 9-12 bits, conversion takes 93.75ms at 9 bits
+        # doubling for every further bit
+        self.resolution = min(max(conf.get("resolution", 12), 9), 12)
+        self.convms = int(93.75*(1 << (self.resolution - 9))) + 1
 
         self.ow = onewire.OneWire(self.pin) # create a OneWire bus
         # ow.scan() # return a list of devices on the bus
         self.ow.reset() # reset the bus
 
     def activate(self):
+        import ds18x20
         self.thermo = None
         for out in self.outs: # check that at least one out is a thermometer
             if isinstance(out, KnovaOwThermometer):
                 self.thermo = ds18x20.DS18X20(self.ow)
                 break
         if self.thermo is not None:
-            self.roms = self.ow.scan()
+            self.discover()
             print("Found one wire devices", self.roms)
+            if self.resolution < 12:
+                self.setresolution()
             super().activate() # schedule timer
 
+    def fingerprint(self):
+        return "owbus:%s" % (self.pinid,)
+
+    def verifyrom(self, rom):
+        try:
+            self.thermo.read_scratch(rom) # fails on crc if absent
+            return True
+        except:
+            return False
+
+    def searchreset(self):
+        self.searchrom = False
+        self.searchdiff = 65
+
+    def searchstep(self):
+        # one step of onewire.scan()
+        if self.searchdiff == 0: return None
+        self.searchrom, self.searchdiff = self.searchnext(self.searchrom, self.searchdiff)
+        if not self.searchrom:
+            self.searchdiff = 0
+            return None
+        return self.searchrom
+
+    def searchnext(self, lastrom, diff):
+        # search of the next rom after lastrom, the algorithm of the
+        # private OneWire._search_rom on the public bit operations
+        ow = self.ow
+        if not ow.reset(): return None, 0
+        ow.writebyte(0xF0) # search rom
+        rom = bytearray(8)
+        nextdiff = 0
+        i = 64
+        for byte in range(8):
+            r = 0
+            for bit in range(8):
+                b = ow.readbit()
+                if ow.readbit():
+                    if b: return None, 0 # no devices or bus error
+                elif not b: # devices differ on this bit
+                    if diff > i or (lastrom and (lastrom[byte] & (1 << bit)) and diff != i):
+                        b = 1
+                        nextdiff = i
+                ow.writebit(b)
+                if b: r |= 1 << bit
+                i -= 1
+            rom[byte] = r
+        return rom, nextdiff
+
+    def setresolution(self):
+        # write default alarm bytes and resolution in DS18B20 configuration
+        buf = bytearray((0x4B, 0x46, ((self.resolution - 9) << 5) | 0x1F))
+        for rom in self.roms:
+            if rom[0] == 0x28:
+                self.thermo.write_scratch(rom, buf)
+
     def periodicupdate(self):
-        if self.thermo is not None:
+        # start conversion and read when it is over, without waiting here
+        if self.thermo is not None and not self.converting:
             self.thermo.convert_temp()
-            time.sleep_ms(750) # is this really necessary? annoying
-            super().propagate(None)
+            self.converting = True
+            KnovaTool.lptimer.addtimerms(self.convms, self.convdone, self.prio)
 
+    def convdone(self):
+        self.converting = False
+        KnovaTool.runsteps(self.propagatesteps(), self.prio)
 
-class KnovaOwI2CBus(KnovaMultiTool):
+    def propagatesteps(self):
+        # each thermometer reads its sensor, a step per thermometer
+        for out in self.outs:
+            out.propagate(self)
+            yield
+
+
+class KnovaOwI2CBus(KnovaOwBusBase):
     def __init__(self, conf):
         super().__init__(conf)
-        import DS248x
-        self.i2c = machine.I2C(0, scl=machine.pin(conf["pin"][0]),
-                               sda=machine.pin(conf["pin"][1]))
-        address = conf.get("address", 24)
+        import ds248x
+        self.i2c = machine.I2C(0, scl=machine.Pin(conf["pin"][0]),
+                               sda=machine.Pin(conf["pin"][1]))
+        self.address = conf.get("address", 24)
+        # channels to scan on DS2482-800, None for single channel adapters
+        self.channels = conf.get("channels", None)
         self.initdelay = conf.get("initdelay", 0)
         self.updateperiod = conf.get("updateperiod", 60)
+        self.convms = conf.get("convms", 750) # DS18B20 at 12 bits
+        self.temps = {} # rom -> temperature of last conversion round
+        self.readerrors = 0 # sensor reads given up
 
-        self.ds248x = DS248x(self.i2c, self.address) # create a OneWire bus on I2C
+        # "verified" reads the whole scratchpad checking crc, "fast" only
+        # the temperature
+        verify = conf.get("scratchpad", "verified") == "verified"
+        self.ds248x = ds248x.DS248x(self.i2c, self.address,
+                                    verify_crc=verify,
+                                    crc_retries=conf.get("crcretries", 2)) # create a OneWire bus on I2C
 
-    def activate(self):
+    def connect(self):
+        super().connect() # call base connect method
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"stats"), self.getstats)
+
+    def getstats(self, req):
+        # read quality and i2c transactions per operation
+        d = self.ds248x
+        stats = {"crcerrors": d.crc_errors, "retries": d.read_retries,
+                 "failures": d.read_failures, "readerrors": self.readerrors,
+                 "i2ctransactions": d.i2c_transactions, "i2cops": d.i2c_ops}
+        req.sendresponse("application/json", ujson.dumps(stats))
+
+    def fingerprint(self):
+        return "owi2cbus:%d:%s" % (self.address, self.channels)
+
+    def setchannel(self, chan):
+        if chan is not None:
+            self.ds248x.channel = chan # no i2c traffic if already selected
+
+    def verifyrom(self, rom):
+        if rom[0] == 0x28: # DS18B20
+            return self.ds248x.ds18b20_present(rom)
+        return self.ds248x.onewire_verify(rom)
+
+    def searchreset(self):
         self.ds248x.onewire_search_reset()
-        self.roms = []
-        while True:
-            rom = bytearray(8) # detach previous instance, forcing a deep copy
-            if self.ds248x.onewire_search(rom):
-                self.roms.append(rom)
-            else:
-                break
+
+    def searchstep(self):
+        rom = bytearray(8) # detach previous instance, forcing a deep copy
+        if self.ds248x.onewire_search(rom):
+            return rom
+        return None
+
+    def activate(self):
+        self.discover()
         print("Found one wire on I2C devices", self.roms)
+        super().activate() # schedule timer
 
     def periodicupdate(self):
-        super().propagate(None) # is there anything else we should do here?
+        # start conversion on all channels, then read all of them after
+        # a single conversion time
+        if not self.converting:
+            for chan, roms in self.chanroms:
+                if len(roms) > 0:
+                    self.setchannel(chan)
+                    self.ds248x.ds18b20_convert_all()
+            self.converting = True
+            KnovaTool.lptimer.addtimerms(self.convms, self.convdone, self.prio)
+
+    def convdone(self):
+        self.converting = False
+        KnovaTool.runsteps(self.readsteps(), self.prio)
+
+    def readsteps(self):
+        # a step per sensor read and per thermometer update
+        for chan, roms in self.chanroms:
+            for rom in roms:
+                if rom[0] == 0x28: # DS18B20
+                    self.setchannel(chan) # others may have used the bus
+                    try:
+                        self.temps[bytes(rom)] = self.ds248x.ds18b20_read_temperature(rom)
+                    except RuntimeError: # no valid answer, may be gone
+                        self.temps.pop(bytes(rom), None)
+                        self.readerrors += 1
+                        self.romlost(rom)
+                    yield
+        for out in self.outs:
+            out.propagate(self)
+            yield
+
+    def temperature(self, rom):
+        # result of last round, never a blocking conversion here: a sensor
+        # that did not answer in it (or not converted yet) raises OSError
+        t = self.temps.get(bytes(rom), None)
+        if t is None: raise OSError(errno.ENODEV)
+        return t
 
 
 class KnovaOwThermometer(KnovaMultiTool):
     def __init__(self, conf):
         super().__init__(conf)
-        self.romid = conf["romid"]
+        romid = conf["romid"] # hex string from json, or list of bytes
+        if isinstance(romid, str):
+            import binascii
+            romid = binascii.unhexlify(romid.replace(":", ""))
+        self.romid = bytearray(romid)
         self.state = array.array("f",(-10000.,))
+        self.history = KnovaHistory.fromconf(conf, len(self.state))
+        self.bus = None
+        self.cache = KnovaCachedRead(KnovaTool.lptimer, self.readbus,
+                                     conf.get("cachettl", 1000),
+                                     conf.get("cachestale", 0))
+        self.lastseq = 0
         # self.state[0] = 0
         # self.state[1] = 1 # start enabled
 
     def connect(self):
         super().connect() # call base connect method
+        for inp in self.ins: # bus used for reading outside of propagate
+            if isinstance(inp, (KnovaOwBus, KnovaOwI2CBus)):
+                self.bus = inp
         if self.web: # connect to web server
             KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+        self.registerhistory()
+
+    def readbus(self):
+        # a failed read raises OSError, counted by the cache and kept
+        # from the outputs and the history
+        if isinstance(self.bus, KnovaOwBus):
+            try:
+                return self.bus.thermo.read_temp(self.romid)
+            except: # crc error, the sensor may be gone
+                self.bus.romlost(self.romid)
+                raise OSError(errno.EIO)
+        elif isinstance(self.bus, KnovaOwI2CBus):
+            # errors already counted by the bus round
+            return self.bus.temperature(self.romid)
+        raise OSError(errno.ENODEV) # no bus
+
+    def refresh(self):
+        # update state from cache, return True if a new measurement was done
+        val = self.cache.get()
+        if val is None: return False # never read yet
+        self.state[0] = val
+        if self.cache.seq == self.lastseq: return False
+        self.lastseq = self.cache.seq
+        self.lastevent = self.cache.time
+        self.addhistory()
+        return True
+
+    def getstate(self, req):
+        if self.bus is not None: self.refresh()
+        super().getstate(req)
 
     def propagate(self, origin):
-        if isinstance(origin, KnovaOwBus):
-            self.state[0] = origin.thermo.read_temp(self.romid)
-        elif isinstance(origin, KnovaOwI2CBus):
-            self.state[0] = origin.ds248x.ds18b20_temperature(self.romid)
-        self.lastevent = time.time()
+        if isinstance(origin, (KnovaOwBus, KnovaOwI2CBus)):
+            self.bus = origin
+        self.refresh()
+        if self.cache.val is None or self.cache.failed: return # no valid reading
         super().propagate(origin)
 
 
 class KnovaDhtThermoHygro(KnovaMultiTool):
     def __init__(self, conf):
         super().__init__(conf)
-        import dht
         self.pin = machine.Pin(conf["pin"], mode=machine.Pin.IN, pull=machine.Pin.PULL_UP) #...
         self.initdelay = conf.get("initdelay", 0)
         self.updateperiod = conf.get("updateperiod", 60)
         self.computeq = conf.get("computeq", False)
         self.state = array.array("f",(-10000.,-10000.,-10000.))
+        self.history = KnovaHistory.fromconf(conf, len(self.state))
+        # DHT22 cannot be read more often than every 2s
+        self.cache = KnovaCachedRead(KnovaTool.lptimer, self.readthermo,
+                                     max(2000, conf.get("cachettl", 2000)),
+                                     conf.get("cachestale", 0))
+        self.lastseq = 0
 
     def activate(self):
+        import dht
         self.thermo = dht.DHT22(self.pin)
         super().activate() # schedule timer
 
@@ -734,20 +1806,39 @@ class KnovaDhtThermoHygro(KnovaMultiTool):
         super().connect() # call base connect method
         if self.web: # connect to web server
             KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+        self.registerhistory()
 
-    def propagate(self, origin):
+    def readthermo(self):
         self.thermo.measure()
-        self.state[0] = self.thermo.temperature()
-        self.state[1] = self.thermo.humidity()
+        return (self.thermo.temperature(), self.thermo.humidity())
+
+    def refresh(self):
+        # update state from cache, return True if a new measurement was done
+        val = self.cache.get()
+        if val is None: return False # never read yet
+        self.state[0], self.state[1] = val
         # if self.computeq: compute q
-        self.lastevent = time.time()
+        if self.cache.seq == self.lastseq: return False
+        self.lastseq = self.cache.seq
+        self.lastevent = self.cache.time
+        self.addhistory()
+        return True
+
+    def getstate(self, req):
+        self.refresh()
+        super().getstate(req)
+
+    def propagate(self, origin):
+        self.refresh()
         super().propagate(origin)
 
     def periodicupdate(self):
-        super().propagate(None) # is there anything else we should do here?
+        self.propagate(None)
 
 
 class KnovaToggleSwitch(KnovaMultiTool):
+    prio = 1 # actuator
+
     def __init__(self, conf):
         super().__init__(conf)
         self.timerduration = conf.get("timerduration", 60)
@@ -813,6 +1904,8 @@ class KnovaToggleSwitch(KnovaMultiTool):
 
 
 class KnovaTimedSwitch(KnovaMultiTool):
+    prio = 1 # actuator
+
     def __init__(self, conf):
         super().__init__(conf)
         self.timerduration = conf.get("timerduration", 60)
@@ -938,6 +2031,8 @@ class KnovaTimedSwitch(KnovaMultiTool):
 
 
 class KnovaOnOffSwitch(KnovaMultiTool):
+    prio = 1 # actuator
+
     def __init__(self, conf):
         super().__init__(conf)
         self.inputop = conf.get("inputop", "or")
@@ -1070,8 +2165,96 @@ class KnovaOnOffSwitch(KnovaMultiTool):
         self.state[2] = 0
 
 
+# incremental combination of n input values, updated one input at a time:
+# running sum for avg, bottom-up segment tree for max/min, O(1) or O(log n)
+class KnovaAggregator:
+    def __init__(self, op, n):
+        self.op = op
+        self.n = n
+        self.sum = 0.
+        if op == "avg":
+            self.vals = array.array("f", (0. for _ in range(n)))
+        else:
+            # leaves in [n, 2n), node k combines 2k and 2k+1, root in 1
+            self.tree = array.array("f", (0. for _ in range(2*n)))
+            self.comb = max if op == "max" else min
+
+    def set(self, i, v):
+        if self.op == "avg":
+            self.sum += v - self.vals[i]
+            self.vals[i] = v
+            return
+        tree = self.tree
+        comb = self.comb
+        i += self.n
+        tree[i] = v
+        i >>= 1
+        while i >= 1:
+            tree[i] = comb(tree[2*i], tree[2*i+1])
+            i >>= 1
+
+    def value(self):
+        if self.op == "avg":
+            return self.sum/self.n
+        return self.tree[1]
+
+
+# avg/max/min of a value over the last window seconds, kept in nbuckets
+# time buckets which expire as time advances, so that each update is O(1)
+class KnovaTimeWindow:
+    def __init__(self, window, op="avg", nbuckets=10):
+        self.op = op
+        self.nb = nbuckets
+        self.width = max(1, window // nbuckets)
+        self.sum = array.array("f", (0. for _ in range(nbuckets)))
+        self.cnt = array.array("L", (0 for _ in range(nbuckets)))
+        self.min = array.array("f", (0. for _ in range(nbuckets)))
+        self.max = array.array("f", (0. for _ in range(nbuckets)))
+        self.total = 0.
+        self.count = 0
+        self.last = -1 # last bucket written
+
+    def add(self, t, v):
+        b = t // self.width
+        if b != self.last: # expire buckets passed since last update
+            for k in range(max(self.last + 1, b - self.nb + 1), b + 1):
+                i = k % self.nb
+                self.total -= self.sum[i]
+                self.count -= self.cnt[i]
+                self.sum[i] = 0.
+                self.cnt[i] = 0
+            self.last = b
+        i = b % self.nb
+        if self.cnt[i] == 0:
+            self.min[i] = v
+            self.max[i] = v
+        else:
+            if v < self.min[i]: self.min[i] = v
+            if v > self.max[i]: self.max[i] = v
+        self.sum[i] += v
+        self.cnt[i] += 1
+        self.total += v
+        self.count += 1
+
+    def value(self):
+        if self.op == "avg":
+            return self.total/self.count
+        ext = self.max if self.op == "max" else self.min
+        val = None
+        for i in range(self.nb): # constant cost, independent of inputs
+            if self.cnt[i] > 0:
+                if val is None or (ext[i] > val) == (self.op == "max"):
+                    val = ext[i]
+        return val
+
+
 class KnovaRegulator(KnovaMultiTool):
+    prio = 1 # actuator
+
     def __init__(self, conf):
+        # no repetition filter unless configured: it never ran before the
+        # filterreps name was fixed, configs rely on every transition
+        conf["filterreps"] = conf.get("filterreps", 0)
         super().__init__(conf)
         self.invert = conf.get("invert", False)
         self.ttype = conf.get("ttype", "float")
@@ -1091,10 +2274,24 @@ class KnovaRegulator(KnovaMultiTool):
             self.extr = (-1.e308, 0., 1.e308)
         else:
             self.extr = (-65535, 0, 65535)
+        self.window = None
+        if conf.get("window", 0) > 0: # aggregate also in time, seconds
+            self.window = KnovaTimeWindow(conf["window"],
+                                          conf.get("windowop", "avg"),
+                                          conf.get("windowbuckets", 10))
 
 
     def connect(self):
         super().connect() # call base connect method
+        # map each upstream tool to its input slot(s), so that only the
+        # originating input is updated in propagate
+        self.inslots = {}
+        for i in range(len(self.ins)):
+            self.inslots.setdefault(self.ins[i].name, []).append(i)
+        if self.inputop in ("avg", "max", "min"):
+            if len(self.ins) == 0:
+                raise ValueError("%s: %s of no inputs" % (self.name, self.inputop))
+            self.aggr = KnovaAggregator(self.inputop, len(self.ins))
         if self.web: # connect to web server
             KnovaTool.unitlist["web"].register((self.name,"set","thresh"), self.setthresh)
             KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
@@ -1116,25 +2313,26 @@ class KnovaRegulator(KnovaMultiTool):
     def propagate(self, origin):
         if self.inputop == "first":
             newval = self.ins[0].state[self.inputind] # define missing
-        elif self.inputop == "avg":
-            newval = self.extr[1]
-            for inp in self.ins:
-                newval = newval + inp.state[self.inputind] # define missing
-            newval = newval/len(self.ins)
-        elif self.inputop == "max":
-            newval = self.extr[0]
-            for inp in self.ins:
-                newval = max(newval, inp.state[self.inputind]) # define missing
-        elif self.inputop == "min":
-            newval = self.extr[2]
-            for inp in self.ins:
-                newval = min(newval, inp.state[self.inputind]) # define missing
         elif self.inputop == "diff":
             newval = self.ins[1].state[self.inputind] - \
                 self.ins[0].state[self.inputind ] # define missing
+        else: # avg, max, min
+            slots = None
+            if self.val is not None and origin is not None:
+                slots = self.inslots.get(origin.name, None)
+            if slots is None: # first time or unknown origin, full scan
+                for i in range(len(self.ins)):
+                    self.aggr.set(i, self.ins[i].state[self.inputind])
+            else: # update only the input which changed
+                for i in slots:
+                    self.aggr.set(i, origin.state[self.inputind])
+            newval = self.aggr.value()
+        if self.window is not None:
+            self.window.add(KnovaTool.clock.time(), newval)
+            newval = self.window.value()
         if self.val is None: # first time, simplified approach
             self.val = newval
-            state[0] = int(newval > self.thresh == self.invert)
+            self.state[0] = int((newval > self.thresh) == self.invert)
             super().propagate(origin)
         else:
             self.val = newval # old val not needed actually
@@ -1145,12 +2343,657 @@ class KnovaRegulator(KnovaMultiTool):
             newstate = int(
                 ((newval >= self.thresh + self.deltaplus) == self.invert) or
                 ((newval <= self.thresh - self.deltaminus) != self.invert))
-            if newstate != state[0]:
-                state[0] = newstate
+            if newstate != self.state[0]:
+                self.state[0] = newstate
                 super().propagate(origin)
 
 
+# bisection on sorted arrays, bisect module is not available everywhere
+def bisectleft(a, x):
+    lo, hi = 0, len(a)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if a[mid] < x: lo = mid + 1
+        else: hi = mid
+    return lo
+
+def bisectright(a, x):
+    lo, hi = 0, len(a)
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if x < a[mid]: hi = mid
+        else: lo = mid + 1
+    return lo
+
+
+# single level of a threshold bank, downstream tools connect to it by
+# name "<bank>.<n>" and read its state[0] as from a regulator
+class KnovaThresholdLevel(KnovaMultiTool):
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.state = bytearray(1)
+        self.state[0] = 2
+
+
+# many thresholds with hysteresis on a single input, like a set of
+# regulators, rising and falling edges of all levels are kept sorted so
+# that a new value only touches the levels crossed since the previous one
+class KnovaThresholdBank(KnovaMultiTool):
+    prio = 1 # actuator
+
+    def __init__(self, conf):
+        # no repetition filter unless configured, level changes are rare
+        conf["filterreps"] = conf.get("filterreps", 0)
+        super().__init__(conf)
+        self.invert = conf.get("invert", False)
+        self.inputind = conf.get("inputind", 0)
+        n = len(conf["thresh"])
+        deltaplus = conf.get("deltaplus", 0)
+        deltaminus = conf.get("deltaminus", 0)
+        if not isinstance(deltaplus, list): deltaplus = [deltaplus]*n
+        if not isinstance(deltaminus, list): deltaminus = [deltaminus]*n
+        # levels are numbered by increasing threshold
+        levs = sorted([(float(conf["thresh"][i]), float(deltaplus[i]),
+                        float(deltaminus[i])) for i in range(n)])
+        self.thresh = array.array("f", [l[0] for l in levs])
+        self.deltaplus = array.array("f", [l[1] for l in levs])
+        self.deltaminus = array.array("f", [l[2] for l in levs])
+        self.above = bytearray(n) # value is above level n
+        self.val = None
+        self.state = bytearray(n) # output of each level
+        self.levels = []
+        for i in range(n):
+            self.levels.append(KnovaThresholdLevel(
+                {"name":"%s.%d" % (self.name, i), "type":"thresholdlevel",
+                 "filterms":0, "filterreps":0}))
+        self.sortedges()
+
+
+    def sortedges(self):
+        # edges where each level switches up and down, sorted, with the
+        # corresponding level index (up to 65536 levels)
+        n = len(self.thresh)
+        up = sorted([(self.thresh[i] + self.deltaplus[i], i) for i in range(n)])
+        down = sorted([(self.thresh[i] - self.deltaminus[i], i) for i in range(n)])
+        self.upedge = array.array("f", [e[0] for e in up])
+        self.uplev = array.array("H", [e[1] for e in up])
+        self.downedge = array.array("f", [e[0] for e in down])
+        self.downlev = array.array("H", [e[1] for e in down])
+
+
+    def connect(self):
+        super().connect() # call base connect method
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"set","thresh"), self.setthresh)
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+
+
+    def setthresh(self, req):
+        # change a single level, the graph is untouched
+        try:
+            i = int(req.querydict["level"])
+            if i < 0 or i >= len(self.thresh): raise IndexError
+            thresh = float(req.querydict["value"])
+            deltaplus = float(req.querydict.get("deltaplus", self.deltaplus[i]))
+            deltaminus = float(req.querydict.get("deltaminus", self.deltaminus[i]))
+        except:
+            req.senderror(400)
+            return
+        self.thresh[i] = thresh
+        self.deltaplus[i] = deltaplus
+        self.deltaminus[i] = deltaminus
+        self.sortedges()
+        if self.val is not None: # re-evaluate the level on the current value
+            if self.val >= thresh + deltaplus:
+                self.setlevel(i, 1)
+            elif self.val <= thresh - deltaminus:
+                self.setlevel(i, 0)
+        req.sendemptyresponse()
+
+
+    def setlevel(self, i, above):
+        if self.above[i] == above and self.state[i] != 2: return
+        self.above[i] = above
+        self.state[i] = int((above == 0) != self.invert)
+        self.levels[i].state[0] = self.state[i]
+        self.levels[i].propagate(self)
+
+
+    def propagate(self, origin):
+        newval = self.ins[0].state[self.inputind]
+        if self.val is None: # first time, set all levels
+            self.val = newval
+            for i in range(len(self.thresh)):
+                self.state[i] = 2
+                self.setlevel(i, int(newval >= self.thresh[i]))
+            super().propagate(origin)
+            return
+        if self.repetitionfilter(): return
+        oldval = self.val
+        self.val = newval
+        changed = False
+        # closed edges as in setthresh, up when val >= thresh + deltaplus,
+        # down when val <= thresh - deltaminus
+        if newval > oldval: # rising edges in [oldval, newval]
+            for k in range(bisectleft(self.upedge, oldval),
+                           bisectright(self.upedge, newval)):
+                i = self.uplev[k]
+                if self.above[i] == 0:
+                    self.setlevel(i, 1)
+                    changed = True
+        elif newval < oldval: # falling edges in [newval, oldval]
+            for k in range(bisectleft(self.downedge, newval),
+                           bisectright(self.downedge, oldval)):
+                i = self.downlev[k]
+                if self.above[i] == 1:
+                    self.setlevel(i, 0)
+                    changed = True
+        if changed: # tools connected to the whole bank
+            super().propagate(origin)
+
+
+# compiler of combination expressions over the state of other tools:
+# "or", "and", "not", comparisons, + - * /, min(), max(), abs(), numbers
+# and tool names, name[i] meaning state[i] of the tool (name is state[0]);
+# the result is a tree of closures, every state array and index bound at
+# compile time
+class KnovaExprCompiler:
+    cmpops = ("<", "<=", ">", ">=", "==", "!=")
+    funcs = {"min": min, "max": max, "abs": abs}
+
+    def tokenize(text):
+        # class method, list of tokens: numbers as float, names and
+        # operators as str
+        tokens = []
+        i = 0
+        n = len(text)
+        while i < n:
+            c = text[i]
+            if c.isspace():
+                i += 1
+            elif c.isdigit() or (c == "." and i+1 < n and text[i+1].isdigit()):
+                j = i
+                while j < n and (text[j].isdigit() or text[j] == "."): j += 1
+                tokens.append(float(text[i:j]))
+                i = j
+            elif c.isalpha() or c == "_":
+                j = i
+                while j < n and (text[j].isalpha() or text[j].isdigit() or
+                                 text[j] in "_."): j += 1
+                tokens.append(text[i:j])
+                i = j
+            elif text[i:i+2] in ("<=", ">=", "==", "!="):
+                tokens.append(text[i:i+2])
+                i += 2
+            elif c in "()[],+-*/<>":
+                tokens.append(c)
+                i += 1
+            else:
+                raise ValueError("expression: unexpected %s" % c)
+        return tokens
+
+    def names(tokens):
+        # class method, tool names referenced by the expression
+        res = []
+        for i in range(len(tokens)):
+            t = tokens[i]
+            if type(t) is str and (t[0].isalpha() or t[0] == "_") and \
+               t not in ("or", "and", "not", "true", "false") and \
+               not (t in KnovaExprCompiler.funcs and i+1 < len(tokens) and
+                    tokens[i+1] == "("):
+                if t not in res: res.append(t)
+        return res
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def compile(self):
+        f = self.orexpr()
+        if self.pos < len(self.tokens):
+            raise ValueError("expression: unexpected %s" % self.tokens[self.pos])
+        return f
+
+    def peek(self):
+        if self.pos < len(self.tokens): return self.tokens[self.pos]
+        return None
+
+    def take(self, expect=None):
+        t = self.peek()
+        if t is None or (expect is not None and t != expect):
+            raise ValueError("expression: expected %s" % (expect or "operand"))
+        self.pos += 1
+        return t
+
+    def orexpr(self):
+        f = self.andexpr()
+        while self.peek() == "or":
+            self.take()
+            f = KnovaExprCompiler.orop(f, self.andexpr())
+        return f
+
+    def andexpr(self):
+        f = self.notexpr()
+        while self.peek() == "and":
+            self.take()
+            f = KnovaExprCompiler.andop(f, self.notexpr())
+        return f
+
+    def notexpr(self):
+        if self.peek() == "not":
+            self.take()
+            a = self.notexpr()
+            return lambda: not a()
+        return self.cmpexpr()
+
+    def cmpexpr(self):
+        f = self.sumexpr()
+        op = self.peek()
+        if op in self.cmpops:
+            self.take()
+            f = KnovaExprCompiler.cmpop(op, f, self.sumexpr())
+        return f
+
+    def sumexpr(self):
+        f = self.termexpr()
+        while self.peek() in ("+", "-"):
+            op = self.take()
+            f = KnovaExprCompiler.arithop(op, f, self.termexpr())
+        return f
+
+    def termexpr(self):
+        f = self.unary()
+        while self.peek() in ("*", "/"):
+            op = self.take()
+            f = KnovaExprCompiler.arithop(op, f, self.unary())
+        return f
+
+    def unary(self):
+        if self.peek() == "-":
+            self.take()
+            a = self.unary()
+            return lambda: -a()
+        return self.atom()
+
+    def atom(self):
+        t = self.take()
+        if type(t) is float:
+            return lambda: t
+        if t == "(":
+            f = self.orexpr()
+            self.take(")")
+            return f
+        if t in ("true", "false"):
+            v = t == "true"
+            return lambda: v
+        if t in self.funcs and self.peek() == "(":
+            self.take()
+            args = [self.orexpr()]
+            while self.peek() == ",":
+                self.take()
+                args.append(self.orexpr())
+            self.take(")")
+            return KnovaExprCompiler.funcop(self.funcs[t], args)
+        if type(t) is str and (t[0].isalpha() or t[0] == "_"):
+            i = 0
+            if self.peek() == "[":
+                self.take()
+                i = int(self.take())
+                self.take("]")
+            if t not in KnovaTool.unitlist:
+                raise ValueError("expression: unknown tool %s" % t)
+            st = KnovaTool.unitlist[t].state # bound once
+            return lambda: st[i]
+        raise ValueError("expression: unexpected %s" % t)
+
+    # closure builders, a separate scope for every node
+    def orop(a, b):
+        return lambda: a() or b()
+
+    def andop(a, b):
+        return lambda: a() and b()
+
+    def cmpop(op, a, b):
+        if op == "<": return lambda: a() < b()
+        if op == "<=": return lambda: a() <= b()
+        if op == ">": return lambda: a() > b()
+        if op == ">=": return lambda: a() >= b()
+        if op == "==": return lambda: a() == b()
+        return lambda: a() != b()
+
+    def arithop(op, a, b):
+        if op == "+": return lambda: a() + b()
+        if op == "-": return lambda: a() - b()
+        if op == "*": return lambda: a() * b()
+        return lambda: a() / b()
+
+    def funcop(func, args):
+        if len(args) == 1:
+            a = args[0]
+            return lambda: func(a())
+        if len(args) == 2:
+            a, b = args
+            return lambda: func(a(), b())
+        return lambda: func([f() for f in args])
+
+
+# output computed by an expression of the inputs, compiled at connect;
+# the tools named in the expression are connected upstream automatically;
+# "output" is "bool" (0/1, for switches and outputs) or "value" (float)
+class KnovaExpression(KnovaMultiTool):
+    prio = 1 # actuator
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.tokens = KnovaExprCompiler.tokenize(conf["expr"])
+        for name in KnovaExprCompiler.names(self.tokens):
+            if name not in self.upstreamconn:
+                self.upstreamconn.append(name)
+        self.boolean = conf.get("output", "bool") == "bool"
+        if self.boolean:
+            self.state = bytearray(1)
+        else:
+            self.state = array.array("f",(0.0,))
+        self.func = None
+        self.first = True
+
+    def connect(self):
+        super().connect() # call base connect method
+        self.func = KnovaExprCompiler(self.tokens).compile()
+        self.tokens = None
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+
+    def propagate(self, origin):
+        try:
+            val = self.func()
+        except ZeroDivisionError: # a divisor input is 0, keep the output
+            return
+        old = self.state[0]
+        self.state[0] = (1 if val else 0) if self.boolean else val
+        if self.state[0] == old and not self.first: return
+        self.first = False
+        super().propagate(origin)
+
+
+# weekly program as in opentherm/timer.c: a 7x96 table of 15 minute
+# slots, each byte packing the setpoint index of 2 channels in its
+# nibbles; programs are applied once at configuration, the slot of a
+# time gives the setpoints in O(1) and the next slot where something
+# changes is precomputed for every slot, so a single timer is armed for
+# the next transition
+class KnovaWeeklySchedule(KnovaMultiTool):
+    prio = 1 # actuator
+    dayint = 96 # slots per day
+    delta = 86400//96 # seconds per slot
+    shift = (0, 4)
+    erase = (0xf0, 0x0f)
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        # setpoint values by index, a list per channel (max 2), index
+        # 0-15 is what the table stores; on/off by default
+        stp = conf.get("setpoints", [[0, 1]])
+        if not isinstance(stp[0], list): stp = [stp]
+        self.stp = [array.array("f", s) for s in stp[:2]]
+        self.utcoffset = conf.get("utcoffset", 0) # seconds east of UTC
+        self.cronoarr = bytearray(7*self.dayint)
+        default = conf.get("default", 0)
+        if not isinstance(default, list): default = [default]*len(self.stp)
+        for ch in range(len(self.stp)):
+            self.setdefault(default[ch], ch)
+        for prog in conf.get("programs", []):
+            self.apply(prog)
+        self.nextchange = array.array("H", [0]*len(self.cronoarr))
+        self.transitions()
+        self.state = array.array("f", [0.0]*len(self.stp))
+        self.slot = -1
+        self.boundary = 0 # time of the next transition, whole seconds
+
+
+    def setdefault(self, default, ch):
+        # crono_set_default
+        bindef = default << self.shift[ch]
+        for i in range(len(self.cronoarr)):
+            self.cronoarr[i] = (self.cronoarr[i] & self.erase[ch]) | bindef
+
+    def apply(self, prog):
+        # crono_apply, prog is {"stpentry":n, "day":[7 flags from monday],
+        # "starth":h, "startm":m, "stoph":h, "stopm":m, "channel":0}
+        ch = prog.get("channel", 0)
+        entry = prog["stpentry"]
+        if entry >= len(self.stp[ch]): return
+        start = prog.get("starth", 0)*3600 + prog.get("startm", 0)*60
+        stop = prog.get("stoph", 24)*3600 + prog.get("stopm", 0)*60
+        first = (start + self.delta - 1)//self.delta
+        last = min((stop + self.delta - 1)//self.delta, self.dayint)
+        for day in range(7):
+            if not prog["day"][day]: continue
+            for j in range(day*self.dayint + first, day*self.dayint + last):
+                self.cronoarr[j] = (self.cronoarr[j] & self.erase[ch]) | \
+                    (entry << self.shift[ch])
+
+    def transitions(self):
+        # nextchange[i] is the first slot after i, round the week, with
+        # a different content, i itself if the table is constant
+        n = len(self.cronoarr)
+        arr = self.cronoarr
+        nxt = -1
+        for k in range(2*n - 1, -1, -1): # twice, to wrap round the week
+            i = k % n
+            if arr[(i + 1) % n] != arr[i]: nxt = (i + 1) % n
+            if k < n: self.nextchange[i] = i if nxt < 0 else nxt
+
+
+    def slotof(self, t):
+        # the offset is applied to UTC, localtime would add the zone of
+        # the host on CPython and the unix port
+        lt = KnovaTool.clock.gmtime(int(t) + self.utcoffset)
+        secs = lt[3]*3600 + lt[4]*60 + lt[5]
+        return lt[6]*self.dayint + secs//self.delta, secs % self.delta
+
+    def lookup(self, slot, ch=0):
+        # crono_get_stp
+        return self.stp[ch][(self.cronoarr[slot] >> self.shift[ch]) & 0x0f]
+
+
+    def connect(self):
+        super().connect() # call base connect method
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+            KnovaTool.unitlist["web"].register((self.name,"table"), self.gettable)
+
+    def activate(self):
+        super().activate()
+        self.transition()
+
+    def transition(self):
+        # apply the current slot and arm the timer for the next change;
+        # the timer may fire up to the lptimer precision early, the
+        # boundary it was armed for is taken as the time then
+        now = KnovaTool.clock.time()
+        t = max(int(now), self.boundary)
+        slot, insec = self.slotof(t)
+        old = self.cronoarr[self.slot] if self.slot >= 0 else -1
+        changed = self.cronoarr[slot] != old
+        self.slot = slot
+        for ch in range(len(self.stp)):
+            self.state[ch] = self.lookup(slot, ch)
+        if changed:
+            self.lastevent = KnovaTool.clock.time()
+            super().propagate(None)
+        nxt = self.nextchange[slot]
+        self.timer.cancel()
+        if nxt != slot:
+            dist = (nxt - slot) % len(self.cronoarr)
+            self.boundary = t - insec + dist*self.delta
+            self.timer = KnovaTimerInstance(KnovaTool.lptimer,
+                                            math.ceil(self.boundary - now),
+                                            self.transition, prio=self.prio)
+
+    def propagate(self, origin):
+        return # driven by time only
+
+
+    def gettable(self, req):
+        # crono_print, a line of setpoint indexes per day and channel
+        if req.sendheader("text/plain"):
+            for ch in range(len(self.stp)):
+                for day in range(7):
+                    line = "".join(["%x" % ((self.cronoarr[day*self.dayint + j] >> self.shift[ch]) & 0x0f)
+                                    for j in range(self.dayint)])
+                    if not req.sendpart(line + "\n"): break
+        req.sendend()
+
+
+# client of the opentherm/opentherm.c gateway: /machine/get is polled
+# every updateperiod into state, in the order of fields, with requests
+# of the shared pool run as steps in the background; "writes" maps the settable user fields to "tool" or
+# "tool[i]" (state index), their values are coalesced and sent with a
+# single /user/set before the next poll; use an expression tool for
+# scaling, e.g. a regulator to chust; after a failure the polls are
+# spaced twice as much, up to maxbackoff seconds, pending writes are
+# kept and retried
+class KnovaOpenTherm(KnovaMultiTool):
+    prio = 1 # actuator
+    fields = ("mchwstp", "mdhwstp", "mdhwt", "mchon", "mdhwon",
+              "flame", "fault", "faultg", "faults")
+    userfields = ("chust", "dhwust", "roomstp", "chwstp", "dhwstp")
+    intfields = 2 # chust and dhwust are integers
+
+    def __init__(self, conf):
+        conf["updateperiod"] = conf.get("updateperiod", 10)
+        super().__init__(conf)
+        self.maxbackoff = conf.get("maxbackoff", 300)
+        self.url = "http://%s:%d" % (conf["host"], conf.get("port", 80))
+        self.timeout = conf.get("timeout", 2)*1000
+        self.buf = bytearray(conf.get("bufsize", 512)) # /machine/get reply
+        self.busy = False
+        self.writes = [] # (user field index, tool name, state index)
+        writes = conf.get("writes", {})
+        for field in writes:
+            name = writes[field]
+            idx = 0
+            if name.endswith("]"):
+                name, idx = name[:-1].split("[")
+                idx = int(idx)
+            self.writes.append((self.userfields.index(field), name, idx))
+            if name not in self.upstreamconn:
+                self.upstreamconn.append(name)
+        self.pending = array.array("f", [0.0]*len(self.userfields))
+        self.dirty = bytearray(len(self.userfields))
+        self.state = array.array("f", [0.0]*len(self.fields))
+        self.online = False
+        self.backoff = 0 # polls skipped after the last failure
+        self.skip = 0
+        self.polls = 0
+        self.sets = 0
+        self.failures = 0
+
+
+    def connect(self):
+        super().connect() # call base connect method
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getstate)
+            KnovaTool.unitlist["web"].register((self.name,"stats"), self.getstats)
+
+    def propagate(self, origin):
+        # only collect the values, they are sent at the next poll
+        for field, name, idx in self.writes:
+            if origin is not None and origin.name == name:
+                self.pending[field] = origin.state[idx]
+                self.dirty[field] = 1
+
+
+    def periodicupdate(self):
+        if self.skip > 0:
+            self.skip -= 1
+            return
+        if self.busy: return # previous poll still running
+        self.busy = True
+        KnovaTool.runsteps(self.cycle(), self.prio)
+
+    def cycle(self):
+        try:
+            yield from self.flush()
+            yield from self.poll()
+            self.backoff = 0
+        except (OSError, ValueError):
+            self.failures += 1
+            self.online = False
+            self.backoff = min(max(1, 2*self.backoff),
+                               max(1, self.maxbackoff//self.updateperiod - 1))
+            self.skip = self.backoff
+        finally: # whatever ends the cycle, the next poll can start
+            self.busy = False
+
+    def flush(self):
+        # the fields sent are clean from now on, a value propagated during
+        # the post marks its field dirty again for the next one
+        body = ""
+        sent = []
+        for field in range(len(self.userfields)):
+            if not self.dirty[field]: continue
+            self.dirty[field] = 0
+            sent.append(field)
+            val = self.pending[field]
+            if body: body += "&"
+            body += self.userfields[field] + "=" + \
+                (str(int(val)) if field < self.intfields else str(val))
+        if not body: return
+        req = KnovaTool.http.request("POST", self.url + "/user/set", body,
+                                     timeout=self.timeout)
+        try:
+            yield from req.steps()
+            if req.result().status != 200: raise ValueError("user/set status %d" % req.status)
+        except:
+            for field in sent: # send them again at the next poll
+                self.dirty[field] = 1
+            raise
+        self.sets += 1
+
+    def poll(self):
+        req = KnovaTool.http.request("GET", self.url + "/machine/get",
+                                     sink=self.buf, timeout=self.timeout)
+        yield from req.steps()
+        if req.result().status != 200: raise ValueError("machine/get status %d" % req.status)
+        self.received(self.parse(req.length))
+
+    def received(self, changed):
+        self.polls += 1
+        self.lastevent = KnovaTool.clock.time()
+        if changed or not self.online:
+            self.online = True
+            super().propagate(None)
+
+    def parse(self, n):
+        # {key:value,...} with bare keys as sent by the gateway, quoted
+        # keys (json) are accepted too; True if a value changed
+        changed = False
+        text = bytes(self.buf[:n]).decode()
+        for item in text.strip().strip("{}").split(","):
+            kv = item.split(":")
+            if len(kv) != 2: continue
+            key = kv[0].strip().strip('"')
+            if key not in self.fields: continue
+            i = self.fields.index(key)
+            val = float(kv[1])
+            if self.state[i] != val:
+                self.state[i] = val
+                changed = True
+        return changed
+
+
+    def getstats(self, req):
+        req.sendresponse("application/json", ujson.dumps(
+            {"online": self.online, "polls": self.polls, "sets": self.sets,
+             "failures": self.failures, "backoff": self.backoff,
+             "pool": KnovaTool.http.stats()}))
+
+
 class KnovaDigitalOut(KnovaMultiTool):
+    prio = 1 # actuator
+
     def __init__(self, conf):
         super().__init__(conf)
         self.invert = conf.get("invert", False)
@@ -1170,6 +3013,404 @@ class KnovaDigitalOut(KnovaMultiTool):
     def propagate(self, origin):
         self.state[0] = origin.state[0] != self.invert
         self.pin.value(self.state[0])
+        if KnovaTool.trace is not None: KnovaTool.trace.output(self)
+
+
+# latency from input irq to output pin: the irq handler, the scheduled
+# propagation and the output stamp ticks_us in a preallocated ring, a
+# record per output reached from a traced irq, keyed by tool ids
+class KnovaLatencyTrace(KnovaTool):
+    reclen = 6 # src id, dst id, irq, filter passed, propagate, output
+    stages = (("filter", 2, 3), ("queue", 3, 4), ("chain", 4, 5),
+              ("total", 2, 5))
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.size = conf.get("size", 128) # records
+        self.ring = array.array("l", [0]*(self.size*self.reclen))
+        self.pos = 0
+        self.count = 0
+        self.current = -1 # id of the source being propagated
+        self.trun = 0
+        KnovaTool.trace = self
+
+
+    def connect(self):
+        # pending irq stamps per tool id, tools are all created now
+        n = len(KnovaTool.unitlist)
+        self.names = [None]*n
+        for u in KnovaTool.unitlist:
+            self.names[KnovaTool.unitlist[u].id] = u
+        self.tirq = array.array("l", [0]*n)
+        self.tfilt = array.array("l", [0]*n)
+        self.pending = bytearray(n)
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getsummary)
+            KnovaTool.unitlist["web"].register((self.name,"dump"), self.getdump)
+            KnovaTool.unitlist["web"].register((self.name,"reset"), self.resetweb)
+
+
+    def irq(self, src, t0):
+        # irq accepted by the filter, propagation is scheduled next
+        self.tirq[src.id] = t0
+        self.tfilt[src.id] = ticks_us()
+        self.pending[src.id] = 1
+
+    def begin(self, src):
+        if self.pending[src.id]:
+            self.pending[src.id] = 0
+            self.current = src.id
+            self.trun = ticks_us()
+
+    def end(self, src):
+        if self.current == src.id: self.current = -1
+
+    def output(self, dst):
+        if self.current < 0: return
+        r = self.ring
+        i = self.pos*self.reclen
+        r[i+5] = ticks_us()
+        r[i] = self.current
+        r[i+1] = dst.id
+        r[i+2] = self.tirq[self.current]
+        r[i+3] = self.tfilt[self.current]
+        r[i+4] = self.trun
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size: self.count += 1
+
+
+    def records(self):
+        # oldest first
+        start = (self.pos - self.count) % self.size
+        for k in range(self.count):
+            i = ((start + k) % self.size)*self.reclen
+            yield self.ring[i:i+self.reclen]
+
+    def summary(self):
+        # p50, p99 and max in us of every stage, per source>output path
+        paths = {}
+        for rec in self.records():
+            key = "%s>%s" % (self.names[rec[0]], self.names[rec[1]])
+            if key not in paths: paths[key] = []
+            paths[key].append(rec)
+        res = {}
+        for key in paths:
+            recs = paths[key]
+            n = len(recs)
+            res[key] = {"n": n}
+            for name, a, b in self.stages:
+                v = sorted([ticks_diff(rec[b], rec[a]) for rec in recs])
+                res[key][name] = (v[n//2], v[min(n*99//100, n-1)], v[-1])
+        return res
+
+    def dump(self, write):
+        # text for offline analysis: tool names, then a line per record
+        write("# id name\n")
+        for i in range(len(self.names)):
+            write("# %d %s\n" % (i, self.names[i]))
+        write("# src dst irq filter propagate output\n")
+        for rec in self.records():
+            write("%d %d %d %d %d %d\n" % tuple(rec))
+
+    def reset(self):
+        self.pos = 0
+        self.count = 0
+
+
+    def getsummary(self, req):
+        req.sendresponse("application/json", ujson.dumps(self.summary()))
+
+    def getdump(self, req):
+        if req.sendheader("text/plain"):
+            self.dump(req.sendpart)
+        req.sendend()
+
+    def resetweb(self, req):
+        self.reset()
+        req.sendemptyresponse()
+
+
+# per tool cpu time and heap allocation of construction, connect,
+# activate, periodicupdate, propagate and web handlers, exclusive of the
+# nested calls of other tools; the methods of all tools are replaced by
+# accounting wrappers, so the profiler must be the first configured tool
+class KnovaProfiler(KnovaTool):
+    ops = ("init", "connect", "activate", "periodic", "propagate", "web")
+    maxdepth = 16 # nesting of accounted calls
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.maxtools = conf.get("maxtools", 32)
+        n = self.maxtools*len(self.ops)
+        self.calls = array.array("l", [0]*n)
+        self.us = array.array("q", [0]*n)
+        self.heap = array.array("q", [0]*n)
+        # start stamps and time spent in nested calls, per depth
+        self.t0 = array.array("l", [0]*self.maxdepth)
+        self.h0 = array.array("q", [0]*self.maxdepth)
+        self.childus = array.array("q", [0]*self.maxdepth)
+        self.childheap = array.array("q", [0]*self.maxdepth)
+        self.depth = 0
+        self.memalloc = getattr(gc, "mem_alloc", None) # not on CPython
+        KnovaTool.profiler = self
+
+
+    def connect(self):
+        for u in KnovaTool.unitlist:
+            t = KnovaTool.unitlist[u]
+            if t is self: continue
+            t.connect = self.wrap0(t.id, 1, t.connect)
+            t.activate = self.wrap0(t.id, 2, t.activate)
+            t.periodicupdate = self.wrap0(t.id, 3, t.periodicupdate)
+            t.propagate = self.wrap1(t.id, 4, t.propagate)
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getreport)
+            KnovaTool.unitlist["web"].register((self.name,"reset"), self.resetweb)
+
+
+    def wrap0(self, tid, op, f):
+        def wrapper():
+            self.enter()
+            try:
+                return f()
+            finally:
+                self.leave(tid, op)
+        return wrapper
+
+    def wrap1(self, tid, op, f):
+        def wrapper(arg):
+            self.enter()
+            try:
+                return f(arg)
+            finally:
+                self.leave(tid, op)
+        return wrapper
+
+    def wrapweb(self, name, f):
+        tool = KnovaTool.unitlist.get(name, None)
+        return self.wrap1(-1 if tool is None else tool.id, 5, f)
+
+
+    def enter(self):
+        d = self.depth + 1
+        self.depth = d
+        if d >= self.maxdepth: return
+        self.childus[d] = 0
+        self.childheap[d] = 0
+        self.h0[d] = self.memalloc() if self.memalloc else 0
+        self.t0[d] = ticks_us()
+
+    def leave(self, tid, op):
+        t = ticks_us()
+        h = self.memalloc() if self.memalloc else 0
+        d = self.depth
+        self.depth = d - 1
+        if d >= self.maxdepth: return
+        dt = ticks_diff(t, self.t0[d])
+        dh = max(h - self.h0[d], 0) # a collection may free memory meanwhile
+        self.childus[d-1] += dt
+        self.childheap[d-1] += dh
+        if 0 <= tid < self.maxtools:
+            i = tid*len(self.ops) + op
+            self.calls[i] += 1
+            self.us[i] += dt - self.childus[d]
+            self.heap[i] += max(dh - self.childheap[d], 0)
+
+
+    def report(self, n=10, key="us"):
+        # the n tools with most time, heap or calls, with the detail per
+        # operation as [calls, us, heap]
+        nops = len(self.ops)
+        res = []
+        for u in KnovaTool.unitlist:
+            tid = KnovaTool.unitlist[u].id
+            if tid >= self.maxtools: continue
+            tot = {"name": u, "calls": 0, "us": 0, "heap": 0, "ops": {}}
+            for op in range(nops):
+                i = tid*nops + op
+                if self.calls[i] == 0: continue
+                tot["calls"] += self.calls[i]
+                tot["us"] += self.us[i]
+                tot["heap"] += self.heap[i]
+                tot["ops"][self.ops[op]] = [self.calls[i], self.us[i], self.heap[i]]
+            if tot["calls"] > 0: res.append(tot)
+        res.sort(key=lambda t: t[key], reverse=True)
+        return res[:n]
+
+    def reset(self):
+        # init is kept, it happens only once
+        nops = len(self.ops)
+        for i in range(len(self.calls)):
+            if i % nops == 0: continue
+            self.calls[i] = 0
+            self.us[i] = 0
+            self.heap[i] = 0
+
+
+    def getreport(self, req):
+        try:
+            n = int(req.querydict.get("n", 10))
+            key = req.querydict.get("sort", "us")
+            if key not in ("us", "heap", "calls"): raise ValueError
+        except:
+            req.senderror(400)
+            return
+        req.sendresponse("application/json", ujson.dumps(self.report(n, key)))
+
+    def resetweb(self, req):
+        self.reset()
+        req.sendemptyresponse()
+
+
+# cooperative scheduler of the main loop: timer callbacks and steps of
+# long sensor work are queued in priority classes and the highest class
+# with work always runs first, one step at a time, so that input and
+# actuators never wait behind a sensor round; work waiting longer than
+# the budget of its class goes first, wait and run times beyond the
+# budgets are counted
+class KnovaScheduler(KnovaTool):
+    classes = ("input", "actuator", "web", "sensor")
+    budgets = ((20, 10), (50, 20), (200, 100), (5000, 50)) # wait, run ms
+    statnames = ("posted", "run", "dropped", "waitmiss", "runmiss",
+                 "maxwait", "maxrun", "overflow")
+
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.depth = conf.get("queuedepth", 16) # per class
+        self.idlems = conf.get("idlems", 10) # wait for requests when idle
+        budgets = conf.get("budgets", {}) # class name: [wait ms, run ms]
+        n = len(self.classes)
+        self.waitbudget = array.array("l", [budgets.get(self.classes[i], self.budgets[i])[0]
+                                            for i in range(n)])
+        self.runbudget = array.array("l", [budgets.get(self.classes[i], self.budgets[i])[1]
+                                           for i in range(n)])
+        self.queues = [[] for _ in range(n)] # (cb, args, ticks_ms posted)
+        self.stats = array.array("l", [0]*(n*len(self.statnames)))
+        self.webpending = False
+        KnovaTool.scheduler = self
+        KnovaTool.lptimer.dispatch = self.post
+
+
+    def connect(self):
+        if self.web: # connect to web server
+            KnovaTool.unitlist["web"].register((self.name,"get"), self.getreport)
+            KnovaTool.unitlist["web"].register((self.name,"reset"), self.resetweb)
+
+
+    def post(self, prio, cb, *args):
+        # timer callbacks and steps are never dropped, a one-shot lost
+        # would leave its tool waiting forever: past depth the queue
+        # grows and the overflow is counted
+        q = self.queues[prio]
+        st = prio*len(self.statnames)
+        if len(q) >= self.depth: self.stats[st + 7] += 1
+        q.append((cb, args, KnovaTool.clock.ticks_ms()))
+        self.stats[st] += 1
+        return True
+
+    def trypost(self, prio, cb, *args):
+        # droppable work (web polls), refused when the queue is full
+        if len(self.queues[prio]) >= self.depth:
+            self.stats[prio*len(self.statnames) + 2] += 1
+            return False
+        return self.post(prio, cb, *args)
+
+    def poststeps(self, prio, steps):
+        # a generator, run a step (up to a yield) at a time
+        return self.post(prio, None, steps)
+
+
+    def pick(self):
+        # highest class with work, unless a lower one is over its budget
+        clock = KnovaTool.clock
+        now = clock.ticks_ms()
+        best = -1
+        for prio in range(len(self.queues)):
+            q = self.queues[prio]
+            if len(q) == 0: continue
+            if best < 0:
+                best = prio
+            elif clock.ticks_diff(now, q[0][2]) > self.waitbudget[prio]:
+                return prio
+        return best
+
+    def run(self):
+        # run queued work until only steps are left, each step generator
+        # runs one step per call so the main loop gets back to the timers
+        clock = KnovaTool.clock
+        nstats = len(self.statnames)
+        again = [] # steps queued again at the end of their class on return
+        while True:
+            KnovaSafePoint() # irq work before anything else
+            self.poll(0)
+            prio = self.pick()
+            if prio < 0: break
+            cb, args, stamp = self.queues[prio].pop(0)
+            st = prio*nstats
+            wait = clock.ticks_diff(clock.ticks_ms(), stamp)
+            start = clock.us()
+            if cb is None: # next step
+                try:
+                    next(args[0])
+                    again.append((prio, args))
+                except StopIteration:
+                    pass
+            else:
+                cb(*args)
+            run = clock.ticks_diff(clock.us(), start)//1000
+            self.stats[st+1] += 1
+            if wait > self.waitbudget[prio]: self.stats[st+3] += 1
+            if run > self.runbudget[prio]: self.stats[st+4] += 1
+            if wait > self.stats[st+5]: self.stats[st+5] = wait
+            if run > self.stats[st+6]: self.stats[st+6] = run
+        now = clock.ticks_ms()
+        for prio, args in again:
+            self.queues[prio].append((None, args, now))
+
+    def pending(self):
+        for q in self.queues:
+            if len(q) > 0: return True
+        return False
+
+    def poll(self, ms):
+        # queue a ready web request, or just wait ms without a web server
+        web = KnovaTool.unitlist.get("web", None)
+        if web is None or not hasattr(web, "httpoll"):
+            if ms > 0: KnovaTool.clock.sleep(ms/1000)
+        elif not self.webpending and web.wait(ms):
+            self.webpending = self.trypost(web.prio, self.serveweb, web)
+
+    def serveweb(self, web):
+        self.webpending = False
+        web.http_ready()
+
+    def idle(self):
+        # no wait while steps are left for the next run
+        self.poll(0 if self.pending() else self.idlems)
+
+
+    def report(self):
+        nstats = len(self.statnames)
+        res = {}
+        for prio in range(len(self.classes)):
+            c = {"pending": len(self.queues[prio]),
+                 "budget": [self.waitbudget[prio], self.runbudget[prio]]}
+            for i in range(nstats):
+                c[self.statnames[i]] = self.stats[prio*nstats + i]
+            res[self.classes[prio]] = c
+        return res
+
+    def reset(self):
+        for i in range(len(self.stats)):
+            self.stats[i] = 0
+
+
+    def getreport(self, req):
+        req.sendresponse("application/json", ujson.dumps(self.report()))
+
+    def resetweb(self, req):
+        self.reset()
+        req.sendemptyresponse()
 
 
 def trivialcb():
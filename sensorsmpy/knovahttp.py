@@ -0,0 +1,407 @@
+
+# pooled HTTP/1.1 client for Knova nodes: connections are kept open and
+# reused per host, host names are resolved once per dnsttl, sockets are
+# non-blocking and every request has a deadline; a request is a
+# generator of short steps (see HttpRequest.steps) that yields whenever
+# the socket would block, so it can run in the background with the
+# Knova scheduler, or at once with run(); responses are read through
+# the fixed buffer of the connection and handed to a sink in chunks;
+# https requests get a connection of their own, blocking up to the
+# timeout of the request, as poll cannot tell when tls data is readable
+
+import socket
+import select
+import errno
+try:
+    from time import ticks_ms, ticks_add, ticks_diff
+except ImportError: # CPython, time ticks from the emulation
+    from sched import ticks_ms, ticks_add, ticks_diff
+
+
+dnscache = {} # (host, port): (address, ticks_ms of expiry)
+dnsttl = 300000 # ms
+
+
+def resolve(host, port):
+    key = (host, port)
+    now = ticks_ms()
+    ent = dnscache.get(key, None)
+    if ent is not None and ticks_diff(ent[1], now) > 0:
+        return ent[0]
+    addr = socket.getaddrinfo(host, port)[0][-1]
+    dnscache[key] = (addr, ticks_add(now, dnsttl))
+    return addr
+
+def forget(host, port):
+    # resolve again at next connection, e.g. after a failed one
+    dnscache.pop((host, port), None)
+
+
+def spliturl(url):
+    # http[s]://host[:port][/path] into host, port, path, tls
+    port = 80
+    tls = False
+    if url.startswith("https://"):
+        url = url[8:]
+        port = 443
+        tls = True
+    elif url.startswith("http://"):
+        url = url[7:]
+    elif "://" in url:
+        raise ValueError("unsupported scheme in " + url)
+    i = url.find("/")
+    if i < 0:
+        hostport, path = url, "/"
+    else:
+        hostport, path = url[:i], url[i:]
+    if ":" in hostport:
+        hostport, port = hostport.split(":")
+        port = int(port)
+    return hostport, port, path, tls
+
+
+def wraptls(sock, host):
+    import ssl
+    if hasattr(ssl, "create_default_context"): # CPython
+        return ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+    return ssl.wrap_socket(sock, server_hostname=host) # no certificate check
+
+
+# a socket to a host with its read buffer, bytes in buf[head:tail] are
+# received and not consumed yet
+class HttpConnection:
+
+    def __init__(self, host, port, bufsize, tls=False):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.buf = bytearray(bufsize)
+        self.mv = memoryview(self.buf)
+        self.head = 0
+        self.tail = 0
+        self.sock = None
+        self.poller = None
+        self.busy = False
+        self.lastused = ticks_ms()
+        self.connects = 0
+        self.requests = 0
+
+
+    def open(self, req):
+        try:
+            addr = resolve(self.host, self.port)
+            self.sock = socket.socket()
+            if self.tls:
+                self.sock.settimeout(req.timeout/1000)
+                self.sock.connect(addr)
+                self.sock = wraptls(self.sock, self.host)
+                self.setio()
+                return
+            self.sock.setblocking(False)
+            try:
+                self.sock.connect(addr)
+            except OSError as e:
+                if e.args[0] != errno.EINPROGRESS: raise
+            self.poller = select.poll()
+            self.poller.register(self.sock, select.POLLOUT)
+            yield from self.wait(select.POLLOUT, req)
+        except OSError:
+            forget(self.host, self.port)
+            self.close()
+            raise
+        self.setio()
+
+    def setio(self):
+        # micropython sockets have readinto and write, CPython ones
+        # recv_into and send
+        self.readinto = getattr(self.sock, "recv_into", None) or self.sock.readinto
+        self.write = getattr(self.sock, "send", None) or self.sock.write
+        self.head = 0
+        self.tail = 0
+        self.connects += 1
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except:
+                pass
+        self.sock = None
+        self.poller = None
+
+
+    def wait(self, mask, req):
+        # yield until the socket is ready for mask, up to the deadline
+        if self.poller is None: return # tls, blocking with a timeout
+        self.poller.modify(self.sock, mask)
+        while True:
+            ev = self.poller.poll(req.slicems)
+            if ev:
+                flags = ev[0][1]
+                # a hang up is the end of a response, a failed connect
+                if flags & select.POLLERR or \
+                   (flags & select.POLLHUP and mask == select.POLLOUT):
+                    raise OSError(errno.ECONNRESET)
+                if flags & (mask | select.POLLHUP): return
+            if ticks_diff(req.deadline, ticks_ms()) <= 0:
+                raise OSError(errno.ETIMEDOUT)
+            yield
+
+    def send(self, data, req):
+        mv = memoryview(data)
+        off = 0
+        while off < len(data):
+            yield from self.wait(select.POLLOUT, req)
+            try:
+                off += self.write(mv[off:])
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN: raise
+
+    def fill(self, req):
+        # receive more bytes after tail, 0 when the server closed
+        if self.head > 0: # move the unread bytes to the start
+            n = self.tail - self.head
+            self.mv[0:n] = self.mv[self.head:self.tail]
+            self.head = 0
+            self.tail = n
+        if self.tail == len(self.buf): raise ValueError("buffer full")
+        while True:
+            yield from self.wait(select.POLLIN, req)
+            try:
+                n = self.readinto(self.mv[self.tail:])
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN: raise
+                n = None
+            if n is not None:
+                self.tail += n
+                return n
+
+
+    def readline(self, req):
+        # a header or chunk size line, must fit the buffer
+        i = self.head
+        while True:
+            while i < self.tail:
+                if self.buf[i] == 10: # \n
+                    line = bytes(self.mv[self.head:i+1])
+                    self.head = i + 1
+                    return line
+                i += 1
+            i -= self.head # fill moves the bytes to the start
+            if (yield from self.fill(req)) == 0:
+                raise OSError(errno.ECONNRESET)
+
+    def copy(self, n, req):
+        # hand n bytes of body to the request, all up to close if n < 0
+        while n != 0:
+            if self.head == self.tail:
+                self.head = 0
+                self.tail = 0
+                if (yield from self.fill(req)) == 0:
+                    if n < 0: return
+                    raise OSError(errno.ECONNRESET)
+            k = self.tail - self.head
+            if n > 0 and k > n: k = n
+            req.deliver(self.mv[self.head:self.head+k])
+            self.head += k
+            if n > 0: n -= k
+
+    def body(self, length, chunked, req):
+        if chunked:
+            while True:
+                size = int((yield from self.readline(req)).split(b";")[0].strip(), 16)
+                if size == 0:
+                    while (yield from self.readline(req)).strip(): pass # trailers
+                    return
+                yield from self.copy(size, req)
+                yield from self.readline(req) # end of chunk
+        else:
+            yield from self.copy(-1 if length is None else length, req)
+
+
+# an exchange on a pooled connection; the body goes to sink, either a
+# function called with each chunk (a memoryview valid during the call
+# only) or a preallocated buffer filled up to length; with conditional
+# the validators of the last response from url are sent and a 304
+# leaves the sink untouched; done is called with the request at the end
+class HttpRequest:
+
+    def __init__(self, client, method, url, body=None,
+                 ctype="application/x-www-form-urlencoded", sink=None,
+                 conditional=False, timeout=None, done=None):
+        self.client = client
+        self.method = method
+        self.url = url
+        self.host, self.port, self.path, self.tls = spliturl(url)
+        self.data = body
+        self.ctype = ctype
+        self.sink = sink
+        self.conditional = conditional
+        self.timeout = client.timeout if timeout is None else timeout
+        self.done = done
+        self.slicems = client.slicems # poll wait per step
+        self.deadline = 0
+        self.status = 0
+        self.length = 0 # body bytes received
+        self.etag = None
+        self.lastmodified = None
+        self.error = None
+        self.finished = False
+
+
+    def steps(self):
+        self.deadline = ticks_add(ticks_ms(), self.timeout)
+        conn = None
+        try:
+            if self.tls: # not pooled
+                conn = HttpConnection(self.host, self.port, self.client.bufsize, True)
+            else:
+                conn = self.client.acquire(self.host, self.port)
+            while True:
+                reused = conn.sock is not None
+                if not reused: yield from conn.open(self)
+                try:
+                    yield from self.exchange(conn)
+                    break
+                except OSError:
+                    # a kept connection may have been dropped by the
+                    # server meanwhile, repeat once on a new one
+                    conn.close()
+                    if not reused or self.status != 0: raise
+        except (OSError, ValueError) as e:
+            self.error = e
+            if conn is not None: conn.close()
+        if conn is not None:
+            if self.tls: conn.close()
+            else: self.client.release(conn)
+        self.finished = True
+        if self.done is not None: self.done(self)
+
+    def run(self):
+        # at once, the steps block in poll up to the deadline
+        self.slicems = self.timeout
+        for _ in self.steps(): pass
+        return self
+
+    def result(self):
+        if self.error is not None: raise self.error
+        return self
+
+
+    def exchange(self, conn):
+        head = "%s %s HTTP/1.1\r\nHost: %s\r\n" % (self.method, self.path, self.host)
+        if self.conditional:
+            etag, lastmodified = self.client.validators.get(self.url, (None, None))
+            if etag is not None: head += "If-None-Match: %s\r\n" % etag
+            if lastmodified is not None: head += "If-Modified-Since: %s\r\n" % lastmodified
+        data = self.data
+        if data is not None:
+            if type(data) is str: data = bytes(data, "utf-8")
+            head += "Content-Type: %s\r\nContent-Length: %d\r\n" % (self.ctype, len(data))
+        conn.requests += 1
+        yield from conn.send(bytes(head + "\r\n", "ascii"), self)
+        if data is not None: yield from conn.send(data, self)
+        line = yield from conn.readline(self)
+        self.status = int(line.split(b" ")[1])
+        close = line.startswith(b"HTTP/1.0")
+        length = None
+        chunked = False
+        while True:
+            line = yield from conn.readline(self)
+            if not line.strip(): break
+            try:
+                k, v = line.split(b":", 1)
+            except ValueError:
+                continue
+            k = k.strip().lower()
+            v = v.strip()
+            if k == b"content-length":
+                length = int(v)
+            elif k == b"transfer-encoding":
+                chunked = v.lower() == b"chunked"
+            elif k == b"connection":
+                close = v.lower() == b"close"
+            elif k == b"etag":
+                self.etag = v.decode()
+            elif k == b"last-modified":
+                self.lastmodified = v.decode()
+        if self.method == "HEAD" or self.status in (204, 304) or self.status < 200:
+            length = 0
+            chunked = False
+        yield from conn.body(length, chunked, self)
+        if close or (length is None and not chunked): conn.close()
+        if self.conditional and self.status == 200:
+            self.client.validators[self.url] = (self.etag, self.lastmodified)
+
+    def deliver(self, mv):
+        n = len(mv)
+        if self.sink is None:
+            pass
+        elif callable(self.sink):
+            self.sink(mv)
+        elif self.length + n > len(self.sink):
+            raise ValueError("response too large")
+        else:
+            self.sink[self.length:self.length+n] = mv
+        self.length += n
+
+    def notmodified(self):
+        return self.status == 304
+
+
+# the pool, at most maxconns sockets, the least recently used idle one
+# is closed when another host needs one
+class HttpClient:
+
+    def __init__(self, maxconns=4, bufsize=512, timeout=5000, slicems=2):
+        self.maxconns = maxconns
+        self.bufsize = bufsize
+        self.timeout = timeout # ms per request
+        self.slicems = slicems
+        self.conns = []
+        self.validators = {} # url: (etag, last-modified)
+
+
+    def acquire(self, host, port):
+        lru = None
+        for conn in self.conns:
+            if conn.busy: continue
+            if conn.host == host and conn.port == port:
+                conn.busy = True
+                return conn
+            if lru is None or ticks_diff(conn.lastused, lru.lastused) < 0:
+                lru = conn
+        if len(self.conns) >= self.maxconns:
+            if lru is None: raise OSError(errno.EAGAIN) # all busy
+            lru.close()
+            self.conns.remove(lru)
+        conn = HttpConnection(host, port, self.bufsize)
+        conn.busy = True
+        self.conns.append(conn)
+        return conn
+
+    def release(self, conn):
+        conn.busy = False
+        conn.lastused = ticks_ms()
+
+
+    def request(self, method, url, body=None, **kw):
+        # to be run by steps() or run()
+        return HttpRequest(self, method, url, body, **kw)
+
+    def get(self, url, sink=None, **kw):
+        return HttpRequest(self, "GET", url, None, sink=sink, **kw).run().result()
+
+    def post(self, url, body, sink=None, **kw):
+        return HttpRequest(self, "POST", url, body, sink=sink, **kw).run().result()
+
+
+    def stats(self):
+        return [{"host": c.host, "port": c.port, "open": c.sock is not None,
+                 "busy": c.busy, "connects": c.connects, "requests": c.requests}
+                for c in self.conns]
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
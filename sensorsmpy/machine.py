@@ -2,6 +2,15 @@
 
 import _thread
 
+clock = None # time source set by the application, see setclock
+
+
+def setclock(newclock):
+    # route the emulated timers and devices through the application clock,
+    # with a virtual clock they run on simulated time instead of threads
+    global clock
+    clock = newclock
+
 class Pin:
     IN = 1
     OUT = 2
@@ -17,6 +26,8 @@ class Pin:
     IRQ_HIGH_LEVEL = 8
     thread = None
     threadstarted = False
+    interactive = True # console thread for changing inputs by hand
+    recorder = None # PinReplay recording output changes
     lock = None
     pinlist = {}
     modestr = (None, "IN", "OUT", "OPEN DRAIN", "ALT OPEN DRAIN")
@@ -25,6 +36,7 @@ class Pin:
     def __init__(self, pinid, mode=-1, pull=-1, value=None, drive=0, alt=-1):
         self.pinid = str(pinid)
         if mode != -1: self.mode = mode
+        elif not hasattr(self, "mode"): self.mode = Pin.IN
         if pull != -1: self.pull = pull
         if self.mode == Pin.OUT or self.mode == Pin.OPEN_DRAIN:
             if value is not None:
@@ -42,14 +54,15 @@ class Pin:
         self.obuf = 0
         self.handler = None
 
-        if Pin.lock is not None: Pin.lock.acquire()
+        if Pin.lock is None: Pin.lock = _thread.allocate_lock()
+        Pin.lock.acquire()
         Pin.pinlist[self.pinid] = self
-        if Pin.lock is not None: Pin.lock.release()
+        Pin.lock.release()
 
-        if not Pin.threadstarted:
+        if not Pin.threadstarted and Pin.interactive and \
+           (clock is None or not clock.virtual):
             Pin.thread =_thread.start_new_thread(Pin.pinteract,(0,))
             Pin.threadstarted = True
-            Pin.lock = _thread.allocate_lock()
 
     def init(self, mode=-1, pull=-1, value=None, drive=0, alt=-1):
         self.__init__(self.pinid, mode, pull, value, drive, alt)
@@ -60,6 +73,8 @@ class Pin:
             if self.mode == Pin.IN:
                 self.obuf = x
             elif self.mode == Pin.OUT:
+                if Pin.recorder is not None and x != self.ovalue:
+                    Pin.recorder.record(self, x)
                 Pin.lock.acquire()
                 self.ovalue = x
                 Pin.lock.release()
@@ -82,8 +97,25 @@ class Pin:
         self.trigger = trigger
 
 
+    def setinput(self, new):
+        # change the level seen by the board and call the irq handler on
+        # a matching edge
+        Pin.lock.acquire()
+        if self.mode == Pin.IN:
+            cur = self.value()
+            self.ovalue = new
+        else:
+            cur = self.obuf
+            self.obuf = new
+        Pin.lock.release()
+        if self.handler is not None:
+            if (new > cur and self.trigger & Pin.IRQ_RISING) or \
+               (new < cur and self.trigger & Pin.IRQ_FALLING):
+                self.handler(self)
+
+
     def pinteract(arg):
-        while (True):
+        while (Pin.interactive):
             Pin.lock.acquire()
             for mode in (Pin.IN, Pin.OUT, Pin.OPEN_DRAIN, Pin.ALT_OPEN_DRAIN):
                 head = True
@@ -103,22 +135,461 @@ class Pin:
                 except:
                     print("wrong input")
                     continue
-                Pin.lock.acquire()
-                if pin.mode == Pin.IN:
-                    cur = pin.value()
-                    pin.ovalue = new
-                elif pin.mode == Pin.OUT:
-                    cur = pin.obuf
-                    pin.obuf = new
-                Pin.lock.release()
-                if pin.handler is not None:
-                    if (new > cur and pin.trigger & Pin.IRQ_RISING) or \
-                       (new < cur and pin.trigger & Pin.IRQ_FALLING):
-                        print("calling irq", pin.handler)
-                        pin.handler(pin)
+                pin.setinput(new)
+
+
+class PinReplay:
+    # replays a trace of input edges (seconds from start, pinid, value)
+    # into the pins, calling their irq handlers, and records the changes
+    # of the output pins; with a virtual clock the edges become clock
+    # events, otherwise they are played from a thread in real time
+    # divided by speed, speed 0 meaning as fast as possible
+    def __init__(self, trace, speed=1.0):
+        Pin.interactive = False # replaces the console thread
+        Pin.recorder = self
+        if type(trace) is str: trace = PinReplay.load(trace)
+        self.trace = iter(trace)
+        self.speed = speed
+        self.inputs = [] # (us, pinid, value) as played
+        self.outputs = [] # (us, pinid, value) as recorded
+        self.start = 0
+        self.done = False
+        self.realus = 0 # real time taken by the replay
+
+    def load(filename):
+        # text trace, a "<seconds> <pinid> <value>" line per edge
+        with open(filename) as f:
+            for line in f:
+                ops = line.split()
+                if len(ops) != 3 or ops[0].startswith("#"): continue
+                yield (float(ops[0]), ops[1], int(ops[2]))
+
+    def save(self, filename):
+        # recorded edges, same format as the input trace
+        with open(filename, "w") as f:
+            for ev in sorted(self.inputs + self.outputs):
+                f.write("%.6f %s %d\n" % ((ev[0] - self.start)/1000000, ev[1], ev[2]))
+
+    def record(self, pin, value):
+        self.outputs.append((ticks_us(), pin.pinid, value))
+
+    def play(self, ev):
+        self.inputs.append((ticks_us(), ev[1], ev[2]))
+        Pin.pinlist[ev[1]].setinput(ev[2])
+
+    def run(self):
+        # start playing, returns at once unless speed is 0 without a
+        # virtual clock
+        self.start = ticks_us()
+        self.realstart = realus()
+        if clock is not None and clock.virtual:
+            self.next()
+        elif self.speed > 0:
+            _thread.start_new_thread(PinReplay.realtime, (self,))
+        else:
+            for ev in self.trace:
+                self.play(ev)
+            self.finish()
+
+    def next(self):
+        # schedule the next edge on the virtual clock
+        ev = next(self.trace, None)
+        if ev is None:
+            self.finish()
+            return
+        def fire():
+            self.play(ev)
+            self.next()
+        clock.after(max(self.start + int(ev[0]*1000000) - clock.us(), 0), fire)
+
+    def realtime(self):
+        for ev in self.trace:
+            delay = self.start + int(ev[0]*1000000/self.speed) - ticks_us()
+            if delay > 2000: sleepus(delay)
+            elif delay > 0: waitus(delay)
+            self.play(ev)
+        self.finish()
+
+    def finish(self):
+        self.realus = realus() - self.realstart
+        self.done = True
+
+    def latencies(self, inpin, outpin, value=None):
+        # us from each edge on inpin (only to value if given) to the next
+        # change of outpin, edges not followed by a change before the next
+        # edge are skipped
+        res = []
+        ins = [ev[0] for ev in self.inputs if ev[1] == str(inpin) and
+               (value is None or ev[2] == value)]
+        outs = [ev[0] for ev in self.outputs if ev[1] == str(outpin)]
+        j = 0
+        for i in range(len(ins)):
+            while j < len(outs) and outs[j] < ins[i]: j += 1
+            if j == len(outs): break
+            if i + 1 < len(ins) and outs[j] >= ins[i+1]: continue
+            res.append(outs[j] - ins[i])
+        return res
+
+    def throughput(self):
+        # input edges handled per real second
+        if self.realus <= 0: return 0
+        return len(self.inputs)*1000000/self.realus
+
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id, mode=PERIODIC, period=-1, callback=None):
+        self.id = id
+        self.gen = 0 # invalidates the thread of a previous init
+        if callback is not None:
+            self.init(mode=mode, period=period, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, callback=None):
+        self.gen += 1
+        self.mode = mode
+        self.period = period
+        self.callback = callback
+        if clock is not None and clock.virtual:
+            gen = self.gen
+            clock.after(self.period*1000, lambda: self.fire(gen))
+        else:
+            _thread.start_new_thread(Timer.run, (self, self.gen))
+
+    def deinit(self):
+        self.gen += 1
+
+    def fire(self, gen):
+        # virtual clock event
+        if gen != self.gen: return
+        if self.mode == Timer.PERIODIC:
+            clock.after(self.period*1000, lambda: self.fire(gen))
+        self.callback(self)
+
+    def run(self, gen):
+        import time
+        while True:
+            time.sleep(self.period/1000)
+            if gen != self.gen: return
+            self.callback(self)
+            if self.mode == Timer.ONE_SHOT: return
+
+
+class ADC:
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+
+    def __init__(self, pin, atten=None, attn=None):
+        self.pin = pin
+
+    def read_u16(self): # use input pin value as full scale fraction
+        return min(int(self.pin.value()*65535), 65535)
+
+
+def ticks_us():
+    # clock of the emulated devices
+    if clock is not None: return clock.us()
+    return realus()
+
+
+def realus():
+    import time
+    try:
+        return time.ticks_us()
+    except AttributeError: # CPython
+        return time.perf_counter_ns()//1000
+
+
+def sleepus(us):
+    import time
+    time.sleep(us/1000000)
+
+
+def waitus(us):
+    # spin, sleep is not precise enough for I2C transfers
+    if clock is not None and clock.virtual:
+        clock.advance(us)
+        return
+    end = ticks_us() + us
+    while ticks_us() < end:
+        pass
+
+
+def crc8(data, crc=0):
+    # Dallas/Maxim 1-Wire crc, bitwise, good enough for the emulator
+    for b in data:
+        for _ in range(8):
+            mix = (crc ^ b) & 0x01
+            crc >>= 1
+            if mix: crc ^= 0x8C
+            b >>= 1
+    return crc
+
+
+class OneWireDS18B20:
+    # virtual DS18B20 working at 1-Wire time slot level, bit() is called
+    # for every slot with the bit written by the master (1 for read slots)
+    # and returns the bit driven by the device (1 = released); a
+    # conversion is visible in the scratchpad only after its duration
+    def __init__(self, serial, temperature=20.0):
+        rom = bytearray(8)
+        rom[0] = 0x28
+        for i in range(6):
+            rom[1+i] = (serial >> (8*i)) & 0xFF
+        rom[7] = crc8(rom[:7])
+        self.rom = rom
+        self.temperature = temperature # float or callable returning float
+        self.scratchpad = bytearray((0x50, 0x05, 0x4B, 0x46, 0x7F, 0xFF, 0x0C, 0x10, 0))
+        self.scratchpad[8] = crc8(self.scratchpad[:8])
+        self.state = "idle"
+        self.corrupt = 0 # number of next scratchpad reads to corrupt
+        self.convend = None # ticks_us when running conversion completes
+
+    def reset(self):
+        self.state = "romcmd"
+        self.nbit = 0
+        self.byte = 0
+        return True # presence pulse
+
+    def rombit(self, i):
+        return (self.rom[i >> 3] >> (i & 7)) & 1
+
+    def convert(self):
+        res = (self.scratchpad[4] >> 5) & 3 # 0 => 9 bits ... 3 => 12 bits
+        self.convend = ticks_us() + (93750 << res)//1000
+
+    def latch(self):
+        # copy the result of a completed conversion to the scratchpad
+        if self.convend is None or ticks_us() < self.convend: return
+        self.convend = None
+        t = self.temperature() if callable(self.temperature) else self.temperature
+        res = (self.scratchpad[4] >> 5) & 3
+        raw = int(round(t*16)) & ~((1 << (3 - res)) - 1) & 0xFFFF
+        self.scratchpad[0] = raw & 0xFF
+        self.scratchpad[1] = raw >> 8
+        self.scratchpad[8] = crc8(self.scratchpad[:8])
+
+    def receive(self, bit):
+        # collect a command byte, LSB first, return it when complete
+        self.byte |= bit << self.nbit
+        self.nbit += 1
+        if self.nbit < 8: return None
+        b = self.byte
+        self.nbit = 0
+        self.byte = 0
+        return b
+
+    def bit(self, mbit):
+        st = self.state
+        if st == "romcmd":
+            cmd = self.receive(mbit)
+            if cmd == 0xCC: self.state = "funccmd"
+            elif cmd == 0x55: self.state = "match"
+            elif cmd == 0x33:
+                self.state = "readout"
+                self.out = self.rom
+            elif cmd == 0xF0:
+                self.state = "search"
+                self.phase = 0
+            elif cmd is not None: self.state = "idle"
+            return 1
+        if st == "match":
+            if mbit != self.rombit(self.nbit):
+                self.state = "idle"
+                return 1
+            self.nbit += 1
+            if self.nbit == 64:
+                self.nbit = 0
+                self.state = "funccmd"
+            return 1
+        if st == "search":
+            b = self.rombit(self.nbit)
+            if self.phase == 0:
+                self.phase = 1
+                return b
+            if self.phase == 1:
+                self.phase = 2
+                return 1 - b
+            if mbit != b:
+                self.state = "idle"
+                return 1
+            self.phase = 0
+            self.nbit += 1
+            if self.nbit == 64:
+                self.nbit = 0
+                self.state = "funccmd"
+            return 1
+        if st == "funccmd":
+            cmd = self.receive(mbit)
+            if cmd == 0x44:
+                self.convert()
+                self.state = "idle"
+            elif cmd == 0xBE:
+                self.latch()
+                self.state = "readout"
+                self.out = bytearray(self.scratchpad)
+                if self.corrupt > 0:
+                    self.corrupt -= 1
+                    self.out[0] ^= 0x10
+            elif cmd == 0x4E:
+                self.state = "writesp"
+                self.nbyte = 0
+            elif cmd is not None: self.state = "idle"
+            return 1
+        if st == "writesp":
+            b = self.receive(mbit)
+            if b is not None:
+                self.scratchpad[2+self.nbyte] = b
+                self.nbyte += 1
+                if self.nbyte == 3:
+                    self.scratchpad[4] = (b & 0x60) | 0x1F
+                    self.scratchpad[8] = crc8(self.scratchpad[:8])
+                    self.state = "idle"
+            return 1
+        if st == "readout":
+            if self.nbit >= 8*len(self.out): return 1
+            b = (self.out[self.nbit >> 3] >> (self.nbit & 7)) & 1
+            self.nbit += 1
+            return b
+        return 1
+
+
+class DS248xDevice:
+    # DS2484 (1 channel) or DS2482-800 (8 channels) register and command
+    # model; 1-Wire commands keep the device busy for their duration
+    # 1-Wire timings in us at standard and overdrive speed
+    treset = (1148, 146)
+    tslot = (72, 11)
+    chancodes = (0xB8, 0xB1, 0xAA, 0xA3, 0x9C, 0x95, 0x8E, 0x87)
+
+    def __init__(self, i2c, nchannels=1):
+        self.i2c = i2c
+        self.buses = [[] for _ in range(nchannels)]
+        self.chan = 0
+        self.devreset()
+
+    def devreset(self):
+        self.status = 0x10
+        self.config = 0
+        self.ptr = 0xF0
+        self.data = 0
+        self.busyuntil = 0
+
+    def add(self, dev, chan=0):
+        self.buses[chan].append(dev)
+        return dev
+
+    def speed(self):
+        return 1 if self.config & 0x08 else 0
+
+    def onewire(self, duration):
+        self.busyuntil = ticks_us() + duration
+        self.ptr = 0xF0
+
+    def slot(self, mbit):
+        val = 1
+        for dev in self.buses[self.chan]:
+            val &= dev.bit(mbit)
+        return val & mbit
+
+    def write(self, buf):
+        cmd = buf[0]
+        if cmd != 0xF0 and cmd != 0xE1 and ticks_us() < self.busyuntil:
+            return # ignored while the 1-Wire bus is busy
+        if cmd == 0xF0:
+            self.devreset()
+        elif cmd == 0xE1:
+            self.ptr = buf[1]
+        elif cmd == 0xD2:
+            if (buf[1] >> 4) == (~buf[1] & 0x0F):
+                self.config = buf[1] & 0x0F
+                self.status &= ~0x10
+            self.ptr = 0xC3
+        elif cmd == 0xC3:
+            code = buf[1]
+            for c in range(len(self.buses)):
+                if code == (c + (~c << 4)) & 0xFF:
+                    self.chan = c
+            self.ptr = 0xD2
+        elif cmd == 0xB4:
+            pres = False
+            for dev in self.buses[self.chan]:
+                pres = dev.reset() or pres
+            self.status = (self.status & 0xF0) | (0x02 if pres else 0) | 0x08
+            self.onewire(self.treset[self.speed()])
+        elif cmd == 0x87:
+            b = self.slot(1 if buf[1] & 0x80 else 0)
+            self.status = (self.status & ~0x20) | (0x20 if b else 0)
+            self.onewire(self.tslot[self.speed()])
+        elif cmd == 0xA5:
+            for i in range(8):
+                self.slot((buf[1] >> i) & 1)
+            self.onewire(8*self.tslot[self.speed()])
+        elif cmd == 0x96:
+            self.data = 0
+            for i in range(8):
+                self.data |= self.slot(1) << i
+            self.onewire(8*self.tslot[self.speed()])
+        elif cmd == 0x78:
+            b1 = self.slot(1)
+            b2 = self.slot(1)
+            if b1 != b2: d = b1
+            else: d = 1 if buf[1] & 0x80 else 0
+            self.slot(d)
+            self.status = (self.status & 0x1F) | (b1 << 5) | (b2 << 6) | (d << 7)
+            self.onewire(3*self.tslot[self.speed()])
+
+    def read(self):
+        if self.ptr == 0xF0:
+            busy = 1 if ticks_us() < self.busyuntil else 0
+            return (self.status & 0xFE) | busy
+        if self.ptr == 0xE1: return self.data
+        if self.ptr == 0xC3: return self.config
+        if self.ptr == 0xD2: return self.chancodes[self.chan]
+        return 0xFF
+
+
+class I2C:
+    # emulated I2C bus with devices attached by address, every transfer
+    # takes its duration at the bus frequency
+    def __init__(self, id, scl=None, sda=None, freq=400000, timeout=50000):
+        self.id = id
+        self.freq = freq
+        self.devices = {}
+        self.transactions = 0
+
+    def attach(self, address, device):
+        self.devices[address] = device
+        return device
+
+    def transfer(self, nbytes):
+        # address byte plus data, 9 clocks each, plus start/stop overhead
+        self.transactions += 1
+        waitus((nbytes + 1)*9*1000000//self.freq + 10)
+
+    def scan(self):
+        return list(self.devices.keys())
+
+    def writeto(self, addr, buf, stop=True):
+        self.transfer(len(buf))
+        if addr not in self.devices: raise OSError(19) # ENODEV
+        self.devices[addr].write(buf)
+        return 1
+
+    def readfrom_into(self, addr, buf, stop=True):
+        self.transfer(len(buf))
+        if addr not in self.devices: raise OSError(19)
+        for i in range(len(buf)):
+            buf[i] = self.devices[addr].read()
 
+    def readfrom(self, addr, nbytes, stop=True):
+        buf = bytearray(nbytes)
+        self.readfrom_into(addr, buf, stop)
+        return buf
 
-                        
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+
+# stand-in for the HTTP interface of the opentherm/opentherm.c gateway,
+# for running the opentherm tool on the unix port and CPython: same
+# endpoints and bare-key reply format, the boiler just follows the user
+# settings as update_machine does; connections are kept alive as in
+# HTTP/1.1 unless keepalive is False (as the Arduino WebServer does),
+# fail makes the next requests answer 500 and down drops connections
+
+import socket
+import time
+import _thread
+
+
+class OpenThermGateway:
+    machinefields = ("mchwstp", "mdhwstp", "mdhwt", "mchon", "mdhwon",
+                     "flame", "fault", "faultg", "faults")
+    userfields = ("chust", "dhwust", "roomt", "roomstp", "chwstp", "dhwstp",
+                  "mchwstp", "mdhwstp", "chon", "dhwon")
+    # settable fields with their valid range, as in setuser
+    limits = {"chust": (0, 3), "dhwust": (0, 2), "roomstp": (10., 40.),
+              "chwstp": (30., 45.), "dhwstp": (30., 60.)}
+
+    def __init__(self, port=0, addr="127.0.0.1", keepalive=True):
+        self.values = {"chust": 0, "dhwust": 0, "roomt": 20., "roomstp": 20.,
+                       "chwstp": 45., "dhwstp": 40., "chon": 0, "dhwon": 0,
+                       "mchwstp": 0., "mdhwstp": 0., "mdhwt": 35.,
+                       "mchon": 0, "mdhwon": 0, "flame": 0,
+                       "fault": 0, "faultg": 0, "faults": 0}
+        self.keepalive = keepalive
+        self.fail = 0 # number of next requests answered with error 500
+        self.down = False
+        self.connections = 0
+        self.requests = 0
+        self.sets = [] # bodies received by /user/set
+        self.lock = _thread.allocate_lock()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(socket.getaddrinfo(addr, port)[0][-1])
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        _thread.start_new_thread(self.serve, ())
+
+
+    def serve(self):
+        while True:
+            try:
+                cl, addr = self.sock.accept()
+            except OSError:
+                return # closed
+            if self.down:
+                cl.close()
+                continue
+            self.connections += 1
+            _thread.start_new_thread(self.client, (cl,))
+
+    def client(self, cl):
+        fp = cl.makefile("rwb", 0)
+        try:
+            while self.handle(fp): pass
+        except OSError:
+            pass
+        cl.close()
+
+    def handle(self, fp):
+        # serve a request, False when the connection has to be closed
+        line = fp.readline(1024)
+        if not line: return False
+        meth, path, proto = line.decode().split(" ")
+        length = 0
+        while True:
+            line = fp.readline(1024)
+            if not line or line == b"\r\n": break
+            k, v = line.split(b":", 1)
+            if k.strip().lower() == b"content-length": length = int(v)
+        body = fp.read(length).decode() if length > 0 else ""
+        self.lock.acquire()
+        self.requests += 1
+        code, rep = 500, "error"
+        if self.fail > 0:
+            self.fail -= 1
+        elif meth == "POST" and path == "/user/set":
+            code, rep = 200, self.setuser(body)
+        elif meth == "GET" and path == "/user/get":
+            code, rep = 200, self.reply(self.userfields)
+        elif meth == "GET" and path == "/machine/get":
+            code, rep = 200, self.reply(self.machinefields)
+        elif path == "/test":
+            code, rep = 200, "this works as well"
+        else:
+            code, rep = 404, "Not found"
+        self.lock.release()
+        keep = self.keepalive and not self.down
+        fp.write(bytes("HTTP/1.1 %d %s\r\nContent-Type: text/json\r\n"
+                       "Content-Length: %d\r\nConnection: %s\r\n\r\n%s" %
+                       (code, "OK" if code == 200 else "Error", len(rep),
+                        "keep-alive" if keep else "close", rep), "ascii"))
+        return keep
+
+
+    def setuser(self, body):
+        self.sets.append(body)
+        for el in body.split("&"):
+            try:
+                k, v = el.split("=", 1)
+                lo, hi = self.limits[k]
+                v = int(v) if isinstance(lo, int) else float(v)
+            except (KeyError, ValueError):
+                continue
+            if lo <= v <= hi: self.values[k] = v
+        self.update()
+        return "OK"
+
+    def update(self):
+        # update_machine without the thermostat and the crono programs
+        v = self.values
+        v["chon"] = 1 if v["chust"] == 3 or \
+            (v["chust"] in (1, 2) and v["roomt"] < v["roomstp"]) else 0
+        v["dhwon"] = 1 if v["dhwust"] > 0 else 0
+        v["mchwstp"] = v["chwstp"] if v["chust"] > 0 else 0.
+        v["mdhwstp"] = v["dhwstp"] if v["dhwust"] > 0 else 0.
+        v["mchon"] = v["chon"]
+        v["mdhwon"] = v["dhwon"]
+        v["flame"] = 1 if v["mchon"] or (v["mdhwon"] and v["mdhwt"] < v["mdhwstp"]) else 0
+
+    def reply(self, fields):
+        return "{" + ",".join(["%s:%s" % (f, self.values[f]) for f in fields]) + "}"
+
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    import sys
+    gw = OpenThermGateway(int(sys.argv[1]) if len(sys.argv) > 1 else 8080, "0.0.0.0")
+    print("opentherm gateway stand-in on port %d" % gw.port)
+    while True:
+        time.sleep(3600)
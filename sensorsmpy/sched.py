@@ -1,4 +1,108 @@
 
+# emulation of micropython.schedule for CPython: callbacks are queued in
+# a fixed depth queue and run later at the safe points of the main loop
+# (runpending), a full queue raises RuntimeError as on the device; the
+# micropython ticks functions are here as well, for modules falling back
+# to them when time has none (the time module is left alone)
+
+import _thread
+import time
+
+depth = 4 # MICROPY_SCHEDULER_DEPTH default
+queue = [None]*depth
+head = 0
+count = 0
+running = False
+lock = _thread.allocate_lock()
+# counters
+scheduled = 0
+executed = 0
+dropped = 0
+highwater = 0
+
+
+def const(x):
+    return x
+
+
+# ticks wrap at the same period as on the device
+ticksperiod = 1 << 30
+
+def ticks_ms():
+    return int(time.monotonic()*1000) & (ticksperiod - 1)
+
+def ticks_us():
+    return int(time.monotonic()*1000000) & (ticksperiod - 1)
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & (ticksperiod - 1)
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + ticksperiod//2) & (ticksperiod - 1)) - ticksperiod//2
+
+def sleep_ms(ms):
+    time.sleep(ms/1000)
+
+def sleep_us(us):
+    time.sleep(us/1000000)
+
+
 def schedule(func, arg):
-    print("scheduling",func,arg)
-    func(arg)
+    global head, count, scheduled, dropped, highwater
+    lock.acquire()
+    if count >= depth:
+        dropped += 1
+        lock.release()
+        raise RuntimeError("schedule queue full")
+    queue[(head + count) % depth] = (func, arg)
+    count += 1
+    scheduled += 1
+    if count > highwater: highwater = count
+    lock.release()
+
+
+def runpending():
+    # run the queued callbacks, not from within a scheduled callback as
+    # on the device; callbacks queued meanwhile run in the same call
+    global head, count, executed, running
+    if running: return
+    running = True
+    try:
+        while True:
+            lock.acquire()
+            if count == 0:
+                lock.release()
+                return
+            func, arg = queue[head]
+            queue[head] = None
+            head = (head + 1) % depth
+            count -= 1
+            executed += 1
+            lock.release()
+            func(arg)
+    finally:
+        running = False
+
+
+def setdepth(n):
+    # change the queue depth, pending callbacks are lost
+    global depth, queue, head, count
+    lock.acquire()
+    depth = n
+    queue = [None]*depth
+    head = 0
+    count = 0
+    lock.release()
+
+
+def stats():
+    return {"depth": depth, "pending": count, "scheduled": scheduled,
+            "executed": executed, "dropped": dropped, "highwater": highwater}
+
+
+def resetstats():
+    global scheduled, executed, dropped, highwater
+    scheduled = 0
+    executed = 0
+    dropped = 0
+    highwater = count